@@ -17,6 +17,17 @@ prompts=("/_full_path_in_your_server_to_/prompts/prompt4.tsv" "/_full_path_in_yo
 
 
 
+# Number of studies sent to the ollama server at the same time (keep it at most OLLAMA_NUM_PARALLEL of the server)
+concurrency=4
+# Number of runs of every study, generated by a single invoker call (with a distinct seed per run)
+runs=5
+# True sends the prompt instruction as the system message, so the server evaluates it once per prompt instead of once
+# per study (the model then reads a different text than in the published runs)
+system_prompt=False
+# Cache of the model responses, shared by all the runs of this script: a request already answered (same model, seed
+# and prompt, e.g. a study of the aquatic set that is asked again in the combined set) is not sent to the model again
+cache_file="/_full_path_in_your_server_to_/results/llm_response_cache.sqlite"
+
 # Define dataset path
 #dataset="/_full_path_in_your_server_to_/datasets/held_out_evaluation_set/combined_held_out.tsv"
 #dataset="/_full_path_in_your_server_to_/datasets/held_out_evaluation_set/aquatic_held_out.tsv"
@@ -27,39 +38,38 @@ for model_choice in "${models[@]}"; do
     model_start_time=$(date +%s)  # Start time for the model
 
     for prompt in "${prompts[@]}"; do
-        for run in {1..5}; do
-            run_start_time=$(date +%s)  # Start time for the run
+        run_start_time=$(date +%s)  # Start time for the runs
 
-            # Generate filenames
-            model_base=$(basename "$model_choice" | tr ':' '_')  # Replace ':' with '_'
-            prompt_base=$(basename "$prompt" .tsv)
+        # Generate filenames
+        model_base=$(basename "$model_choice" | tr ':' '_')  # Replace ':' with '_'
+        prompt_base=$(basename "$prompt" .tsv)
 
-            # Create a directory for the model and prompt combination if it doesn't exist
-            output_dir="/_full_path_in_your_server_to_/results/held_out_evaluation/${model_base}_${prompt_base}"
-            mkdir -p "$output_dir"  # Create the directory if it doesn't exist
+        # Create a directory for the model and prompt combination if it doesn't exist
+        output_dir="/_full_path_in_your_server_to_/results/held_out_evaluation/${model_base}_${prompt_base}"
+        mkdir -p "$output_dir"  # Create the directory if it doesn't exist
 
-            output="$output_dir/LLM_output_${model_base}_${prompt_base}_run_${run}.json"
-            #metrics_output="$output_dir/metrics_LLM_output_${model_base}_${prompt_base}_run_${run}.tsv"
+        # The invoker writes one file per run: LLM_output_${model_base}_${prompt_base}_run_${run}.json
+        output="$output_dir/LLM_output_${model_base}_${prompt_base}.json"
+        #metrics_output="$output_dir/metrics_LLM_output_${model_base}_${prompt_base}_run_${run}.tsv"
 
-            # Execute scripts
-            echo "Running model: $model_choice with prompt: $prompt (Run $run)"
-            /usr/bin/python3 ./structured_output_LLM_invoker_V4.py "$model_choice" "$prompt" "$dataset" "$output"
+        # Execute scripts
+        echo "Running model: $model_choice with prompt: $prompt ($runs runs)"
+        /usr/bin/python3 ./structured_output_LLM_invoker_V4.py "$model_choice" "$prompt" "$dataset" "$output" --concurrency=$concurrency --runs=$runs --system_prompt=$system_prompt --cache_file="$cache_file"
 
 
-            # Capture runtime per run
-            run_end_time=$(date +%s)
-            run_duration=$((run_end_time - run_start_time))
-            run_minutes=$((run_duration / 60))
-            run_seconds=$((run_duration % 60))
-            echo "Model: $model_choice | Run $run completed in $run_minutes min $run_seconds sec" >> "$LOGFILE"
+        # Capture runtime of the runs
+        run_end_time=$(date +%s)
+        run_duration=$((run_end_time - run_start_time))
+        run_minutes=$((run_duration / 60))
+        run_seconds=$((run_duration % 60))
+        echo "Model: $model_choice | $runs runs completed in $run_minutes min $run_seconds sec" >> "$LOGFILE"
 
-        done
         #here
         # After processing all runs for a model-prompt combination, aggregate results into a TSV file
         echo "Aggregating results for $output_dir..."
         /usr/bin/python3 ./5_runs_LLM_summarizer.py "$output_dir"
         # Now getting the final yes/no answer from 5 runs
-        echo "Getting the final yes/no answer from 5 runs for $output_dir..."
+        echo "Getting the final yes/no answer from $runs runs for $output_dir..."
         /usr/bin/python3 ./5_runs_LLM_final_answer.py "$output_dir"
         # Now calculating metrics from the 5 runs
         echo "Getting metrics for $output_dir..."
@@ -75,7 +85,7 @@ for model_choice in "${models[@]}"; do
     model_hours=$((model_duration / 3600))
     model_minutes=$(( (model_duration % 3600) / 60 ))
     model_seconds=$((model_duration % 60))
-    echo "Model: $model_choice | Total runtime for 5 runs: $model_hours hours $model_minutes min $model_seconds sec" >> "$LOGFILE"
+    echo "Model: $model_choice | Total runtime for $runs runs: $model_hours hours $model_minutes min $model_seconds sec" >> "$LOGFILE"
 done
 
 # Capture total script execution time
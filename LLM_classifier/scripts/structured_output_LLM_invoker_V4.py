@@ -6,6 +6,11 @@ from pathlib import Path
 import sys
 import io
 from collections import OrderedDict
+import concurrent.futures
+import hashlib
+import sqlite3
+import threading
+import time
 
 # Reconfigure sys.stdout to use UTF-8 encoding
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -13,20 +18,109 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
 #Note: please update this URL to your own ollama server endpoint and port
 OLLAMA_API_URL = "http://localhost:11434"
+#Number of requests sent to the ollama server at the same time (--concurrency), it should not exceed the parallel
+#sequences that the server serves (OLLAMA_NUM_PARALLEL), the extra requests would only wait in its queue
+CONCURRENCY = 1
+#Number of runs of every study (--runs), run i is generated with the seed SEED + i - 1 (--seed). A single run is
+#generated without a seed, as before, unless --seed is given
+RUNS = 1
+SEED = 1
+#How long the model stays loaded after a request (--keep_alive): it should outlast the gaps between requests, so the
+#model and its cached prompt prefix are never unloaded mid-run. A negative duration (e.g. -1m) keeps it loaded
+KEEP_ALIVE = "30m"
+#With --system_prompt=True the instruction of the prompt and the JSON format instructions are sent as the system
+#message and only the study text as the prompt: everything before the study text is then the same for all the studies,
+#and the server evaluates it once instead of once per study. Off by default, as the model then reads a different text
+#than in the published runs
+SYSTEM_PROMPT = False
+#SQLite file of the response cache (--cache_file), off if None, and its size limit in MB (--cache_max_mb)
+RESPONSE_CACHE_FILE = None
+RESPONSE_CACHE_MAX_MB = 1024
 
-def ask_question(model_name, prompt):
-    """Sends a structured prompt to the model and ensures JSON response."""
+JSON_FORMAT_INSTRUCTIONS = "Please provide your response in JSON format with the following structure:\n{\n    \"explanation\": \"<short explanation>\",\n    \"answer\": \"<***yes*** or ***no***>\"\n}\nOnly return a valid JSON object."
+
+class ResponseCache:
+    """SQLite cache of the model responses, by the hash of the request (model, options with the seed, system message and
+    prompt), shared by the runs, prompts and datasets that ask the same study.
+
+    When the cached responses exceed max_bytes, the least recently used ones are evicted."""
+
+    def __init__(self, cache_path, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(cache_path), timeout=60, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def get_key(payload):
+        """The hash of a request, keep_alive aside (it does not change the response)."""
+        request = {key: value for key, value in payload.items() if key != "keep_alive"}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """The cached response of a request, None if it is not in the cache."""
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def put(self, key, response):
+        response_text = json.dumps(response, ensure_ascii=False)
+        size = len(response_text.encode('utf-8'))
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                                    (key, response_text, size, time.time()))
+            self.total_size += size
+            while self.total_size > self.max_bytes:
+                evicted = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 100").fetchall()
+                self.connection.executemany("DELETE FROM responses WHERE key = ?", [(evicted_key,) for evicted_key, _ in evicted])
+                self.total_size -= sum(evicted_size for _, evicted_size in evicted)
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def ask_question(model_name, prompt, options=None, system=None, keep_alive=KEEP_ALIVE, cache=None):
+    """Sends a structured prompt to the model and ensures JSON response.
+
+    `options` are the model options of the request (e.g. the seed), if any. If `system` is given, it is sent with the
+    JSON format instructions as the system message, and `prompt` alone as the prompt. With a ResponseCache `cache`, the
+    responses of seeded requests are served from and saved to the cache (unseeded responses are not reproducible)."""
     url = "{}/api/generate".format(OLLAMA_API_URL)
     headers = {"Content-Type": "application/json"}
 
-    # Enforce structured JSON response
-    structured_prompt = "{}\n\nPlease provide your response in JSON format with the following structure:\n{{\n    \"explanation\": \"<short explanation>\",\n    \"answer\": \"<***yes*** or ***no***>\"\n}}\nOnly return a valid JSON object.".format(prompt)
-
     payload = {
         "model": model_name,
-        "prompt": structured_prompt,
-        "format": "json"  # Enforce JSON output from the model
+        "format": "json",  # Enforce JSON output from the model
+        "keep_alive": keep_alive
     }
+    # Enforce structured JSON response
+    if system is None:
+        payload["prompt"] = "{}\n\n{}".format(prompt, JSON_FORMAT_INSTRUCTIONS)
+    else:
+        payload["system"] = "{}\n\n{}".format(system, JSON_FORMAT_INSTRUCTIONS)
+        payload["prompt"] = prompt
+    if options:
+        payload["options"] = options
+
+    cache_key = None
+    if cache is not None and options and "seed" in options:
+        cache_key = ResponseCache.get_key(payload)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
     
     try:
         response = requests.post(url, headers=headers, json=payload, stream=True)
@@ -54,56 +148,190 @@ def ask_question(model_name, prompt):
     try:
         parsed_response = json.loads(full_response)  # Ensure response is valid JSON
         if isinstance(parsed_response, dict) and "explanation" in parsed_response and "answer" in parsed_response:
-            return OrderedDict([
+            structured_response = OrderedDict([
                 ("explanation", parsed_response["explanation"]),
                 ("answer", parsed_response["answer"])
             ])
+            if cache_key is not None:
+                cache.put(cache_key, structured_response)
+            return structured_response
         else:
             return {"error": "Unexpected JSON structure from model"}
     except json.JSONDecodeError as e:
         print("Failed to parse final response as JSON: {}".format(e))
         return {"error": "Invalid JSON response from model"}
 
-def process_studies(prompts_file_path, studies_file_path, model_name, output_file_path):
-    """Processes studies and saves JSON responses."""
+def get_run_output_path(output_file_path, run):
+    """The output file of a run: LLM_output_<model>_<prompt>.json -> LLM_output_<model>_<prompt>_run_<run>.json"""
+    return output_file_path.with_name("{}_run_{}{}".format(output_file_path.stem, run, output_file_path.suffix))
+
+def get_checkpoint_path(output_file_path):
+    """The checkpoint of an output file: LLM_output_<model>_<prompt>.json -> LLM_output_<model>_<prompt>.checkpoint.jsonl"""
+    return output_file_path.with_name("{}.checkpoint.jsonl".format(output_file_path.stem))
+
+def get_checkpoint_settings(model_name, seed, runs, system_prompt, studies_file_path):
+    """The settings of an invocation that its responses depend on, saved in the first line of its checkpoint."""
+    with studies_file_path.open('rb') as studies_file:
+        studies_sha256 = hashlib.sha256(studies_file.read()).hexdigest()
+    return OrderedDict([
+        ("model", model_name),
+        ("seed", seed),
+        ("runs", runs),
+        ("system_prompt", system_prompt),
+        ("studies_sha256", studies_sha256)
+    ])
+
+def get_study_hash(study_txt):
+    """The key of a study in the checkpoint: the hash of its text, as two studies could share a Study_ID."""
+    return hashlib.sha256(study_txt.encode('utf-8')).hexdigest()
+
+def load_checkpoint(checkpoint_path):
+    """Loads the settings (None for a new checkpoint) and the responses of a checkpoint, by (Study_hash, Prompt, Run).
+
+    A last line cut by a crash is removed from the file, so that the next responses are appended after a complete line."""
+    settings = None
+    responses = {}
+    if not checkpoint_path.exists():
+        return settings, responses
+
+    with checkpoint_path.open('rb') as checkpoint_file:
+        data = checkpoint_file.read()
+    complete_size = data.rfind(b"\n") + 1
+    if complete_size < len(data):
+        with checkpoint_path.open('r+b') as checkpoint_file:
+            checkpoint_file.truncate(complete_size)
+
+    for line in data[:complete_size].decode('utf-8').splitlines():
+        entry = json.loads(line, object_pairs_hook=OrderedDict)
+        if "Checkpoint" in entry:
+            settings = entry["Checkpoint"]
+        else:
+            responses[(entry["Study_hash"], entry["Prompt"], entry["Run"])] = entry["Response"]
+    return settings, responses
+
+def process_studies(prompts_file_path, studies_file_path, model_name, output_file_path, concurrency=1, runs=1, seed=None,
+                    keep_alive=KEEP_ALIVE, system_prompt=False, cache=None):
+    """Processes studies and saves JSON responses.
+
+    Up to `concurrency` studies are sent to the model at the same time, the results keep the order of the prompts and
+    of the studies in the studies file. With runs > 1 every study is asked `runs` times (run i with the seed
+    seed + i - 1) and every run is saved in its own file (see get_run_output_path). With system_prompt the instruction
+    of the prompt is sent as the system message (see SYSTEM_PROMPT). With a ResponseCache `cache`, the requests that
+    were already answered are served from it.
+
+    Every response is appended to a checkpoint (see get_checkpoint_path) as soon as it arrives. If the invoker is
+    interrupted and restarted, the (study, prompt, run) responses already in the checkpoint are not asked again, provided
+    that the checkpoint was written with the same settings (see get_checkpoint_settings). Once all the responses are
+    saved in the output files the checkpoint is deleted."""
     
     with prompts_file_path.open('r', encoding='utf-8') as prompts_file:
         prompts = [line.strip() for line in prompts_file]
     
-    results = []  # List to store structured output
-    
     with studies_file_path.open('r', encoding='utf-8') as input_file:
-        for prompt in prompts:
-            for line in input_file:
-                study_txt = line.strip()
-                study_id = line.split("\t")[0]
-                
-                final_prompt = "{}\nText: {}".format(prompt.split("\t")[1], study_txt)
-                response_json = ask_question(model_name, final_prompt)
-                
-                results.append(OrderedDict([
-                    ("Study_ID", study_id),
+        study_lines = input_file.readlines()
+
+    # every prompt is asked for every study, in the order of the output: the studies of a prompt are sent contiguously,
+    # so they share the instruction prefix. The runs of a study are sent back-to-back: they share the whole prompt,
+    # which the server can then reuse from its cache instead of evaluating it again
+    jobs = [(prompt, line, run) for prompt in prompts for line in study_lines for run in range(1, runs + 1)]
+
+    def ask_study(job):
+        prompt, line, run = job
+        study_txt = line.strip()
+        options = {"seed": seed + run - 1} if seed is not None else None
+        if system_prompt:
+            return ask_question(model_name, "Text: {}".format(study_txt), options, prompt.split("\t")[1], keep_alive, cache)
+        final_prompt = "{}\nText: {}".format(prompt.split("\t")[1], study_txt)
+        return ask_question(model_name, final_prompt, options, keep_alive=keep_alive, cache=cache)
+
+    def get_job_key(job):
+        prompt, line, run = job
+        return (get_study_hash(line.strip()), prompt, run)
+
+    checkpoint_path = get_checkpoint_path(output_file_path)
+    settings = get_checkpoint_settings(model_name, seed, runs, system_prompt, studies_file_path)
+    checkpoint_settings, responses = load_checkpoint(checkpoint_path)
+    if (checkpoint_settings is None and responses) or (checkpoint_settings is not None and dict(checkpoint_settings) != dict(settings)):
+        print("Error: The checkpoint {} was written with other settings: {}".format(checkpoint_path, json.dumps(checkpoint_settings)))
+        print("The settings of this invocation are: {}".format(json.dumps(settings)))
+        print("Delete the checkpoint to start over with these settings, or restart with the settings of the checkpoint.")
+        sys.exit(1)
+    if responses:
+        print("Resuming from checkpoint {}: {} responses already received".format(checkpoint_path, len(responses)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            checkpoint_path.open('a', encoding='utf-8') as checkpoint_file:
+        if checkpoint_settings is None:
+            checkpoint_file.write(json.dumps(OrderedDict([("Checkpoint", settings)]), ensure_ascii=False) + "\n")
+            checkpoint_file.flush()
+        futures = {executor.submit(ask_study, job): job for job in jobs if get_job_key(job) not in responses}
+        for future in concurrent.futures.as_completed(futures):
+            prompt, line, run = futures[future]
+            key = get_job_key(futures[future])
+            response_json = future.result()
+            responses[key] = response_json
+            # failed requests are not checkpointed, they are asked again on restart
+            if "error" not in response_json:
+                checkpoint_file.write(json.dumps(OrderedDict([
+                    ("Study_ID", line.split("\t")[0]),
+                    ("Study_hash", key[0]),
                     ("Prompt", prompt),
+                    ("Run", run),
                     ("Response", response_json)
-                ]))
-            
-            input_file.seek(0)  # Reset file cursor
+                ]), ensure_ascii=False) + "\n")
+                checkpoint_file.flush()
+
+    run_results = {run: [] for run in range(1, runs + 1)}  # Lists to store structured output, one per run
+
+    # the responses are collected in the order of the jobs, whatever order they are completed in
+    for job in jobs:
+        prompt, line, run = job
+        run_results[run].append(OrderedDict([
+            ("Study_ID", line.split("\t")[0]),
+            ("Prompt", prompt),
+            ("Response", responses[get_job_key(job)])
+        ]))
     
-    with output_file_path.open('w', encoding='utf-8') as output_file:
-        json.dump(results, output_file, indent=4, ensure_ascii=False)
+    for run, results in run_results.items():
+        run_output_file_path = output_file_path if runs == 1 else get_run_output_path(output_file_path, run)
+        with run_output_file_path.open('w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=4, ensure_ascii=False)
     
-    print("JSON output saved to: {}".format(output_file_path))
+        print("JSON output saved to: {}".format(run_output_file_path))
+
+    checkpoint_path.unlink()
+    if cache is not None:
+        print("Responses served from the cache: {}".format(cache.hits))
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
+    # the options are given as --key=value, the rest of the arguments are positional
+    arguments_dict = {}
+    positional_arguments = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--") and '=' in arg:
+            sep = arg.find('=')
+            arguments_dict[arg[:sep]] = arg[sep + 1:]
+        else:
+            positional_arguments.append(arg)
+
+    if len(positional_arguments) != 4:
         print("Error: Expected 4 arguments (model_name, prompts_file, studies_file, output_file).")
-        print("Usage: python structured_output_LLM_invoker_V4.py <model_name> <prompts_file> <studies_file> <output_file>")
+        print("Usage: python structured_output_LLM_invoker_V4.py <model_name> <prompts_file> <studies_file> <output_file> [--concurrency=N] [--runs=N] [--seed=N] [--keep_alive=30m] [--system_prompt=True] [--cache_file=<sqlite_file>] [--cache_max_mb=1024]")
         sys.exit(1)
 
-    model_name = sys.argv[1]
-    prompts_file_path = Path(sys.argv[2])
-    studies_file_path = Path(sys.argv[3])
-    output_file_path = Path(sys.argv[4])
+    model_name = positional_arguments[0]
+    prompts_file_path = Path(positional_arguments[1])
+    studies_file_path = Path(positional_arguments[2])
+    output_file_path = Path(positional_arguments[3])
+    concurrency = int(arguments_dict.get("--concurrency", CONCURRENCY))
+    runs = int(arguments_dict.get("--runs", RUNS))
+    seed = None
+    if runs > 1 or "--seed" in arguments_dict:
+        seed = int(arguments_dict.get("--seed", SEED))
+    keep_alive = arguments_dict.get("--keep_alive", KEEP_ALIVE)
+    system_prompt = eval(arguments_dict.get("--system_prompt", str(SYSTEM_PROMPT)))
+    cache_file = arguments_dict.get("--cache_file", RESPONSE_CACHE_FILE)
+    cache_max_mb = float(arguments_dict.get("--cache_max_mb", RESPONSE_CACHE_MAX_MB))
 
     if not prompts_file_path.exists():
         print("Error: Prompts file does not exist: {}".format(prompts_file_path))
@@ -117,4 +345,12 @@ if __name__ == "__main__":
         print("Error: Output directory does not exist: {}".format(output_file_path.parent))
         sys.exit(1)
 
-    process_studies(prompts_file_path, studies_file_path, model_name, output_file_path)
+    cache = None
+    if cache_file:
+        cache = ResponseCache(Path(cache_file), int(cache_max_mb * 1024 * 1024))
+
+    process_studies(prompts_file_path, studies_file_path, model_name, output_file_path, concurrency, runs, seed,
+                    keep_alive, system_prompt, cache)
+
+    if cache is not None:
+        cache.close()
@@ -0,0 +1,39 @@
+#!/usr/bin/python3.5
+
+########################################################################################
+# script name: build_pubmed_index.py
+# framework: CCMRI - WP1
+########################################################################################
+# GOAL
+# one-time build step of formulate_studies_for_classifier.py: indexes the PubMed .tsv file (PMID -> byte offset and
+# length of its line) in a SQLite file, so that the abstracts of the studies are read with random access instead of a
+# scan of the whole .tsv file. It has to be run again every time the PubMed .tsv file is replaced (a stale index is
+# detected and not used)
+########################################################################################
+## usage: ./build_pubmed_index.py --pubmed_tsv=/_full_path_in_your_server_to_/pubmed2025.tsv
+# --index=/_full_path_in_your_server_to_/pubmed2025_index.sqlite
+########################################################################################
+
+import sys, datetime
+from mgnify_functions import build_pubmed_index
+
+
+PUBMED_TSV_FILE = "/_full_path_in_your_server_to_/pubmed2025.tsv"
+PUBMED_INDEX_FILE = "/_full_path_in_your_server_to_/pubmed2025_index.sqlite"
+
+#extraction of the argument values imported from sys.argv
+arguments_dict = {}
+for arg in sys.argv[1:]:
+    if '=' in arg:
+        sep = arg.find('=')
+        key, value = arg[:sep], arg[sep + 1:]
+        arguments_dict[key] = value
+
+if "--pubmed_tsv" in arguments_dict:
+    PUBMED_TSV_FILE = arguments_dict["--pubmed_tsv"]
+if "--index" in arguments_dict:
+    PUBMED_INDEX_FILE = arguments_dict["--index"]
+
+start = datetime.datetime.now()
+build_pubmed_index(PUBMED_TSV_FILE, PUBMED_INDEX_FILE)
+print("The PubMed index was built: ", PUBMED_INDEX_FILE, " - this took: ", datetime.datetime.now() - start)
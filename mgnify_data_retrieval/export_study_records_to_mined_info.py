@@ -0,0 +1,42 @@
+#!/usr/bin/python3.5
+
+########################################################################################
+# script name: export_study_records_to_mined_info.py
+# framework: CCMRI - WP1
+########################################################################################
+# GOAL
+# the compatibility exporter of the study records dataset (study_records.jsonl) written by get_mgnify_via_studyID.py:
+# it writes the latest record of every study as harvested_mgnify_studies/<study ID>/mined_info_<study ID>.txt, in the
+# text layout that the rest of the pipeline reads (e.g. after a harvest with --mined_info_text=False)
+########################################################################################
+## usage: ./export_study_records_to_mined_info.py --wd='/_full_path_in_your_server_to_/' --records_file=study_records.jsonl
+## note: the working directory should include the trailing slash (/)
+########################################################################################
+
+import sys
+from mgnify_functions import check_create_dir, load_study_records, export_study_record_to_mined_info
+
+
+WORKING_DIR = "/_full_path_in_your_server_to_/"
+STUDY_RECORDS_FILE = "study_records.jsonl"
+
+#extraction of the argument values imported from sys.argv
+arguments_dict = {}
+for arg in sys.argv[1:]:
+    if '=' in arg:
+        sep = arg.find('=')
+        key, value = arg[:sep], arg[sep + 1:]
+        arguments_dict[key] = value
+
+if "--wd" in arguments_dict:
+    WORKING_DIR = arguments_dict["--wd"]
+if "--records_file" in arguments_dict:
+    STUDY_RECORDS_FILE = arguments_dict["--records_file"]
+
+harv_studies = WORKING_DIR + "harvested_mgnify_studies/"
+study_records = load_study_records(WORKING_DIR + STUDY_RECORDS_FILE)
+for study, record in study_records.items():
+    check_create_dir(harv_studies + study)
+    export_study_record_to_mined_info(record, harv_studies + study + "/mined_info_" + study + ".txt")
+
+print("Exported ", len(study_records), " study records to mined_info files in: ", harv_studies)
@@ -11,7 +11,24 @@
 # study id entries from mgnify
 ########################################################################################
 ## usage: ./get_mgnify_via_studyID.py --wd='/_full_path_in_your_server_to_/' --threads=5 
-# --dev_mode=True --studyid_pmid_file=studyid_pmid.tsv --min=1.5 --max=3.5
+# --dev_mode=True --studyid_pmid_file=studyid_pmid.tsv --min=1.5 --max=3.5 --rate=2 --burst=5 --retry_failed=False
+# --incremental=False --with_samples=False --with_downloads=False --download_threads=5
+# --cache=True --cache_max_mb=1024 --offline=False --engine=threads --async_concurrency=50 --mined_info_text=True
+## note: --retry_failed=True re-drives only the urls kept in the failure ledger (failure_ledger.tsv) of the previous run
+## note: --incremental=True harvests only the studies that are new or whose last-update differs from the study manifest
+## note: --with_samples=True also writes the ID and the description of every sample of a study (sample_nr_* lines)
+## note: --with_downloads=True also downloads the study files of the ANALYSIS_GROUP_TYPES_TO_INCLUDE group types
+## (resumable, into the downloads/ folder of every study) with a pool of --download_threads transfers
+## note: the JSON answers of the server are cached in the response_cache/ folder of the working directory and revalidated
+## with conditional GETs; --offline=True serves everything from that cache and sends no request at all
+## note: the number of studies of every PMID is kept up to date in pmid_study_counts.sqlite, from which the formulation
+## derives its blocklist (studyid_pmid.tsv is still written as well)
+## note: every harvested study is a JSON line of the study records dataset (study_records.jsonl); --mined_info_text=False
+## skips exporting the records to the mined_info_<study ID>.txt text files of the study folders as well
+## note: --engine=async runs the whole harvest on one asyncio event loop (mgnify_async_client.py, needs the aiohttp
+## package) with up to --async_concurrency requests in flight, instead of the thread pools of the default engine (threads)
+## note: --rate is the allowed number of requests per second to the MGnify server over all threads; by default
+## it is threads / average sleep, i.e. the same aggregate rate that the per-request random sleeps used to give
 ## note: the working directory should include the trailing slash (/)
 ########################################################################################
 
@@ -21,12 +38,12 @@ import os, glob
 import requests, time, datetime
 import json, re, os, sys, traceback, asyncio
 import concurrent.futures
-import shutil, wget
+import shutil, threading, atexit
 import re
 from requests.exceptions import Timeout
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
-from mgnify_functions import get_page, load_json_file, retry, download_pages, check_create_dir, download_file_via_wget_url, get_json_url_with_exception_handling, remove_dir, clean_text
+from mgnify_functions import get_page, load_json_file, check_create_dir, get_json_url_with_exception_handling, remove_dir, clean_text, build_study_record, append_study_record, export_study_record_to_mined_info, configure_http_session, configure_rate_limiter, configure_failure_ledger, finalize_failure_ledger, load_failure_ledger, load_study_manifest, save_study_manifest, read_last_update_from_mined_info, StudyRegistry, open_pmid_study_counter, download_file_with_resume, start_queue_logging, stop_queue_logging, QueueLoggingStream, stdout_logger, summarize_request_metrics, configure_response_cache
 import logging
 
 
@@ -36,25 +53,40 @@ WORKING_DIR = "/_full_path_in_your_server_to_/"
 NUM_OF_THREADS = 5
 DEVELOPMENT_MODE_ENABLED = True
 STUDY_PMID_FILE = "studyid_pmid.tsv"
+PMID_COUNTER_FILE = "pmid_study_counts.sqlite"
 SLEEP_MIN = 1.5
 SLEEP_MAX = 3.5
 
 DEEP_LOG_ENABLED = True
-RECURSIONS_LIMIT = 2
+RECURSIONS_LIMIT = 5    #attempts per url before it is kept in the failure ledger
+FAILURE_LEDGER_FILE = "failure_ledger.tsv"
+RETRY_FAILED_ONLY = False
+STUDY_MANIFEST_FILE = "study_manifest.tsv"
+INCREMENTAL_MODE = False
+SAMPLES_ENABLED = False
+DOWNLOADS_ENABLED = False
+NUM_OF_DOWNLOAD_THREADS = 5
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_MAX_MB = 1024
+OFFLINE_MODE = False
+STUDY_RECORDS_FILE = "study_records.jsonl"
+MINED_INFO_TEXT_ENABLED = True
+ENGINE = "threads"    #threads or async
+ASYNC_CONCURRENCY = 50
 NUMBER_OF_STUDY_PAGES_LIMIT = 1    #must be >1 and no more than mgnify's recorded studies
 MGNIFY_REST_API_URL_BASE = 'https://www.ebi.ac.uk/metagenomics/api/v1/'
 
 
 #print("Initially: " + WORKING_DIR+ ", " + str(NUM_OF_THREADS) + ", " + str(DEVELOPMENT_MODE_ENABLED) + ", " + STUDY_PMID_FILE,"\n")
 
-#e.g. If we want to filter info mined from json files
-#ANALYSIS_GROUP_TYPES_TO_INCLUDE = {
-#  "Taxonomic analysis": False,	
-#   "Functional analysis": False,	
-#   "Taxonomic analysis LSU rRNA": True,
-#   "Taxonomic analysis SSU rRNA": True,
-#   "Statistics": False
-#}
+#e.g. If we want to filter info mined from json files - the downloads of a study are filtered by their group type
+ANALYSIS_GROUP_TYPES_TO_INCLUDE = {
+   "Taxonomic analysis": False,
+   "Functional analysis": False,
+   "Taxonomic analysis LSU rRNA": True,
+   "Taxonomic analysis SSU rRNA": True,
+   "Statistics": False
+}
 
 
 #extraction of the argument values imported from sys.argv
@@ -78,6 +110,44 @@ if "--sleep_min" in arguments_dict:
     SLEEP_MIN = arguments_dict["--sleep_min"]
 if "--sleep_max" in arguments_dict:
     SLEEP_MAX = arguments_dict["--sleep_min"]
+if "--retry_failed" in arguments_dict:
+    RETRY_FAILED_ONLY = eval(arguments_dict["--retry_failed"])
+if "--incremental" in arguments_dict:
+    INCREMENTAL_MODE = eval(arguments_dict["--incremental"])
+if "--with_samples" in arguments_dict:
+    SAMPLES_ENABLED = eval(arguments_dict["--with_samples"])
+if "--with_downloads" in arguments_dict:
+    DOWNLOADS_ENABLED = eval(arguments_dict["--with_downloads"])
+if "--download_threads" in arguments_dict:
+    NUM_OF_DOWNLOAD_THREADS = int(arguments_dict["--download_threads"])
+if "--cache" in arguments_dict:
+    RESPONSE_CACHE_ENABLED = eval(arguments_dict["--cache"])
+if "--cache_max_mb" in arguments_dict:
+    RESPONSE_CACHE_MAX_MB = int(arguments_dict["--cache_max_mb"])
+if "--offline" in arguments_dict:
+    OFFLINE_MODE = eval(arguments_dict["--offline"])
+if "--mined_info_text" in arguments_dict:
+    MINED_INFO_TEXT_ENABLED = eval(arguments_dict["--mined_info_text"])
+if "--engine" in arguments_dict:
+    ENGINE = arguments_dict["--engine"]
+if "--async_concurrency" in arguments_dict:
+    ASYNC_CONCURRENCY = int(arguments_dict["--async_concurrency"])
+if ENGINE not in ("threads", "async"):
+    print("Unknown engine: ", ENGINE, " - it should be threads or async\n")
+    sys.exit(1)
+
+#the pooled HTTP session of mgnify_functions keeps one open connection per thread, the study list executor, the
+#study executor, the sample page executor and the download executor run at the same time so all of their threads are counted
+configure_http_session((3 if SAMPLES_ENABLED else 2) * int(NUM_OF_THREADS) + (NUM_OF_DOWNLOAD_THREADS if DOWNLOADS_ENABLED else 0))
+
+#all the threads share one token bucket limiting the requests per second sent to the MGnify server
+REQUESTS_PER_SEC = int(NUM_OF_THREADS) / ((float(SLEEP_MIN) + float(SLEEP_MAX)) / 2)
+REQUESTS_BURST = int(NUM_OF_THREADS)
+if "--rate" in arguments_dict:
+    REQUESTS_PER_SEC = float(arguments_dict["--rate"])
+if "--burst" in arguments_dict:
+    REQUESTS_BURST = int(arguments_dict["--burst"])
+configure_rate_limiter(REQUESTS_PER_SEC, REQUESTS_BURST)
 
 #print("Finally: " + WORKING_DIR+ ", " + str(NUM_OF_THREADS) + ", " + str(DEVELOPMENT_MODE_ENABLED) + ", " + STUDY_PMID_FILE,"\n")
 
@@ -106,363 +176,490 @@ check_create_dir(mgnify_wd)
 log_file_path = "/_full_path_in_your_server_to_/logs/"
 check_create_dir(log_file_path)
 log_file_name = log_file_path + "mgnify_via_studyID_"+ str(date) + ".log"
-log_file = open(log_file_name,"w")
-sys.stdout = log_file   #redirecting stardard out to the log file
-study_list_page_json_dir = mgnify_wd + "studies_list_page_json_files/"
-check_create_dir(study_list_page_json_dir)
+#This code is for the tracking of URL calls for the efficient use of the mgnify server: every request is a JSON line in url_calls.log
+#Both logs are written by a single listener thread that reads a queue, so the threads never wait on the log files
+log_listener = start_queue_logging(log_file_name, log_file_path+"url_calls.log")
+sys.stdout = QueueLoggingStream(stdout_logger)   #redirecting stardard out to the (queue-backed) log file
+
+#the listener must write the queue to the log files on every exit path (sys.exit, an uncaught exception or the end of the script)
+def restore_stdout_and_stop_logging():
+    sys.stdout.flush()
+    sys.stdout = old_stdout
+    stop_queue_logging(log_listener)
+
+atexit.register(restore_stdout_and_stop_logging)
 harv_studies = mgnify_wd + "harvested_mgnify_studies/"
 check_create_dir(harv_studies)
+#the on-disk cache of the JSON answers of the MGnify server
+if RESPONSE_CACHE_ENABLED or OFFLINE_MODE:
+    configure_response_cache(mgnify_wd + "response_cache/", RESPONSE_CACHE_MAX_MB * 1024 * 1024, OFFLINE_MODE)
 #opening the file to store studyids - pmids
 studyid_pmid_file_full_path = mgnify_wd+STUDY_PMID_FILE 
 studyid_pmid_file_handler = open(studyid_pmid_file_full_path, "a")
+#the number of studies of every PMID, kept up to date as the studies are harvested (the blocklist of the formulation)
+pmid_study_counter = open_pmid_study_counter(mgnify_wd + PMID_COUNTER_FILE, studyid_pmid_file_full_path)
 
-#This code is for the tracking of URL calls for the efficient use of the mgnify server
-#now we will Create and configure logger (import required - is found above)
-logging.basicConfig(filename=log_file_path+"url_calls.log", 
-					format='%(asctime)s %(message)s', 
-					filemode='w') 
-#Let us Create an object 
-logger=logging.getLogger() 
-#Now we are going to Set the threshold of logger to DEBUG 
-logger.setLevel(logging.DEBUG)
+#the urls that permanently fail in this run are kept in the failure ledger, it replaces the previous one when the run finishes. When re-driving, the previous ledger is read first
+failure_ledger_full_path = mgnify_wd + FAILURE_LEDGER_FILE
+previous_failures = []
+if RETRY_FAILED_ONLY:
+    previous_failures = load_failure_ledger(failure_ledger_full_path)
+    print("Re-driving the ", len(previous_failures), " failed urls of the failure ledger: ", failure_ledger_full_path, "\n")
+configure_failure_ledger(failure_ledger_full_path)
 
 
-##########################################################################################################################
-## STEP 1
-## Find all mgnify study API links, save them in a list and download their json files
-##########################################################################################################################
+#the records of all the harvested studies, one JSON line per study
+study_records_full_path = mgnify_wd + STUDY_RECORDS_FILE
 
-# this is the URL for the first page for all mgnify studies.
-url_studies_pages=MGNIFY_REST_API_URL_BASE+"studies?page=1"
+#the study manifest keeps the last-update of every harvested study between the runs
+study_manifest_full_path = mgnify_wd + STUDY_MANIFEST_FILE
+study_manifest = load_study_manifest(study_manifest_full_path)
 
-#we need to get the json variable from the above URL in order to count the study pages
-json_data = get_json_url_with_exception_handling(url_studies_pages, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
 
 
-# get the total number of study pages from the json variable
-number_of_pages = json_data['meta']['pagination']['pages']
-print("\nNumber of study data pages to be retrieved: " + str(number_of_pages) + "\n")
+##########################################################################################################################
+## STEP 3
+## Get all the text info and links we are going to need from every study and download all the downloads per study
+## (it is defined first: STEP 1 and STEP 2 stream every study ID to it as soon as its study list page arrives)
+##########################################################################################################################
 
-# get all the study URLs in a list - We manipulate the nr in the "while counter < page_limiter" to test the script
-counter = 0
-page_limiter = number_of_pages   #will iterate though all the study pages
-if DEVELOPMENT_MODE_ENABLED==True:
-    page_limiter = NUMBER_OF_STUDY_PAGES_LIMIT
-study_urls = []
-while counter < page_limiter :
-    counter += 1
-    page_url= MGNIFY_REST_API_URL_BASE+"studies?page=" + str(counter)
-    study_urls.append(page_url)
+study_counter = 0
+asc_study_counter = 0
+#the counters and the studyid_pmid file are shared by all the threads of the study executor
+step_3_lock = threading.Lock()
+
+#the study files are downloaded by their own bounded pool of transfers, shared by all the studies
+download_executor = None
+if DOWNLOADS_ENABLED:
+    download_executor = concurrent.futures.ThreadPoolExecutor(max_workers = NUM_OF_DOWNLOAD_THREADS)
+
+#the sample pages 2..N of a study are fetched in parallel by their own executor, shared by all the studies
+sample_page_executor = None
+if SAMPLES_ENABLED:
+    sample_page_executor = concurrent.futures.ThreadPoolExecutor(max_workers = int(NUM_OF_THREADS))
+
+
+# get all the sample pages of a study: the first sample page reveals the number of pages, the rest of them are fetched
+# concurrently and returned in page order. Returns None if not all the pages were retrieved
+def fetch_study_sample_pages(study):
+    #we get the link for "samples" like this:
+    #url_samples = study_json['data']['relationships']['samples']['links']['related']
+    url_samples = MGNIFY_REST_API_URL_BASE+'studies/'+study+'/samples?page='
+
+    #geting the page info for samples
+    json_data_samples = get_json_url_with_exception_handling(url_samples+"1", 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study)
+    if json_data_samples is None:
+        return None
+
+    # get the total number of pages 
+    number_of_pages = int(json_data_samples['meta']['pagination']['pages'])
+    print("Number of sample pages to be retrieved from "+study+": " + str(number_of_pages) + "\n")
+
+    # the futures are kept in page order, so that the samples are numbered and written in the order of the pages
+    page_futures = [sample_page_executor.submit(get_json_url_with_exception_handling, url_samples+str(page_nr), 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study) for page_nr in range(2, number_of_pages + 1)]
+    sample_pages = [json_data_samples] + [future.result() for future in page_futures]
+    if None in sample_pages:
+        return None
+    return sample_pages
+
+
+# submit every file of the desired group types of a study to the download executor and wait for them,
+# returns True only if all of them were downloaded
+def download_study_files(study, study_json):
+    #we get the link for "downloads" like this:
+    url_downloads = study_json['data']['relationships']['downloads']['links']['related']
+    download_dir = harv_studies+study+"/downloads/"
+    check_create_dir(download_dir)
+
+    download_futures = []
+    page_nr = 1
+    number_of_pages = 1
+    while page_nr <= number_of_pages:
+        dwn_json = get_json_url_with_exception_handling(url_downloads+"?page="+str(page_nr), 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study)
+        if dwn_json is None:
+            return False
+        if 'meta' in dwn_json and dwn_json['meta'].get('pagination'):
+            number_of_pages = dwn_json['meta']['pagination']['pages']
+        #now we go though every download link in the study
+        for download in range(len(dwn_json['data'])):
+            group_type = dwn_json['data'][download]['attributes']['group-type']
+            if ANALYSIS_GROUP_TYPES_TO_INCLUDE.get(group_type):
+                dwn_url = dwn_json['data'][download]['links']['self']
+                download_futures.append(download_executor.submit(download_file_with_resume, dwn_url, download_dir, 60, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study))
+        page_nr += 1
+
+    downloaded_files = [future.result() for future in download_futures]
+    print("Downloaded ", len([path for path in downloaded_files if path is not None]), " of the ", len(downloaded_files), " files of study: ", study, "\n")
+    return None not in downloaded_files
+
+
+# checks the 'COMPLETED' file of a study: returns False if the study is already harvested, otherwise it resets the
+# study directory and returns True
+def start_study_harvest(study):
+    global study_counter
+    #adding a separator for reading comfort
+    print("=================================================================================================================\n")
     
-
-# Use an executor, built thanks to the concurrent.futures package, using the number of threads you want to, in order to perform your download!
-print("The study list executor is about to start. \n" + str(datetime.datetime.now()))
-with concurrent.futures.ThreadPoolExecutor(max_workers = int(NUM_OF_THREADS)) as executor:
-    print("The executor for downloading studies list pages just started! \n")
-    # Start the load operations and mark each future with its URL. HERE is where the concurrent.futures part is taking place!
-    future_to_url = {executor.submit(download_pages, url, study_list_page_json_dir, "_study_list_page.json", 15, SLEEP_MIN, SLEEP_MAX): url for url in study_urls}
-
-
-# The urls that failed, they have been kept in a temp file. Read that file and keep each url as a list element.
-temp_file = study_list_page_json_dir + "temp_file_with_failed_urls.tsv"
-f = open(temp_file, "w")
-#for i in range(1, "number of study pages" + 1):
-for i in range(1, page_limiter + 1):     # The page_limiter has to be the number of study pages we whish to download
-    item = str(i) + "_study_list_page.json"
-    file = study_list_page_json_dir + item
+    
+    #checking if the file COMPLETED exists and if the study is already harvested
+    isExist = os.path.exists(harv_studies+study+"/COMPLETED")
+    if isExist:
+        print("File 'COMPLETED' found in study with ID: ",study,". Will continue to the next study\n")
+        return False
+    else:
+        print("File 'COMPLETED' NOT found in study with ID: ",study,"\n")
+        print("Directory reset: ", harv_studies+study ,"\n")
+        remove_dir(harv_studies+study) 
+    
+    #we are keeping track of how many studies have been harvested so far
+    with step_3_lock:
+        study_counter += 1
+        current_study_nr = study_counter
+    print("We are in study nr",current_study_nr," with study ID: ",study, "\n")
+    return True
+
+
+# build the record of a study out of its json variables: the study json, the publications json (None if the study has
+# no publications link) and the sample pages (None if the samples are not harvested). The record is appended to the study
+# records dataset and, unless --mined_info_text=False, exported to the mined_info file of the study as well
+def write_study_record(study, study_json, pub_json, sample_pages):
+    global asc_study_counter
+    record = build_study_record(study_json, pub_json, sample_pages)
+    append_study_record(study_records_full_path, record)
+    if MINED_INFO_TEXT_ENABLED:
+        export_study_record_to_mined_info(record, harv_studies+study+"/mined_info_"+study+".txt")
+
+    with step_3_lock:
+        asc_study_counter += len(record["associated_studies"])
+        if record["publications"] is not None:
+            for pub_record in record["publications"]:
+                studyid_pmid_file_handler.write(study+"\t"+str(pub_record["pubmed_id"])+"\n")
+    if record["publications"] is not None:
+        pmid_study_counter.add_study_pmids(study, [str(pub_record["pubmed_id"]) for pub_record in record["publications"]])
+
+    if sample_pages is not None:
+        print("Total number of sample pages retrieved:",len(sample_pages),"\n")
+        print("Total number of samples:",len(record["samples"]),"\n")
+
+
+# creates the 'COMPLETED' file of a study and keeps its last-update in the study manifest
+def complete_study(study, study_json):
+    #now creating the 'COMPLETED' file
+    completion_file = open(harv_studies+study+"/COMPLETED", "w", encoding='utf-8')
+    completion_file.close()
+    print("File 'COMPLETED' created\n")
+    with step_3_lock:
+        study_manifest[study] = study_json['data']['attributes']['last-update']
+
+
+# gather the desired information for a single study ID - this is what every thread of the study executor runs
+def harvest_study(study):
     try:
-        f = open(file)
-    except IOError:
-        print("File " + file + " was not accessible in the first attempt! \n")
-        with open(temp_file, "a") as temp:
-            missing_url= MGNIFY_REST_API_URL_BASE+"studies?page=" + str(i) + "\n"
-            temp.write(missing_url)
-            temp.close()
-    finally:
-        f.close()
+        if not start_study_harvest(study):
+            return
 
-# make a list with all the missing urls
-failed_study_urls = [line[:-1] for line in open(temp_file, "r").readlines()]
-print("The number of the missing urls is equal to " + str(len(failed_study_urls)) + "\n")
+        # read the page of every study from the id's obtained in json format
+        url=MGNIFY_REST_API_URL_BASE+"studies/" + study
+        study_json = get_json_url_with_exception_handling(url, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study)
+        if study_json is None:
+            print("The study json could not be retrieved for study:",study,". It is kept in the failure ledger\n")
+            return
 
+        #now we need to access other attributes like "publications" which are in a new json.
+        #we get the link for "publications" like this:
+        pub_json = None
+        url_publications = study_json['data']['relationships']['publications']['links']['related']
+        if url_publications:
+            pub_json = get_json_url_with_exception_handling(url_publications, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, study)
+            if pub_json is None:
+                print("The publications json could not be retrieved for study:",study,". It is kept in the failure ledger\n")
+                return
 
-# for as long as there are still missing urls..
-while len(failed_study_urls) > 0 :
-    print("We still have " + str(len(failed_study_urls)) + " urls to get! \n")
-    # .... perform the "retry" function. 
-    retry(failed_study_urls, study_list_page_json_dir, "_study_list_page.json", float(SLEEP_MIN), float(SLEEP_MAX))
+        #the samples are harvested only when asked with --with_samples=True
+        sample_pages = None
+        if SAMPLES_ENABLED:
+            sample_pages = fetch_study_sample_pages(study)
+            if sample_pages is None:
+                print("Not all the sample pages of study:",study,"were retrieved. They are kept in the failure ledger\n")
+                return
 
-# erase everything from the temp_file without removing it - in order to use it in the next run of the robot.
-#open(temp_file, 'w').close()
-# HZ: After discussed the robots architecture, it is better to remove this temp file after getting all the studies needed. 
+        write_study_record(study, study_json, pub_json, sample_pages)
 
-os.remove(temp_file)
+        #after we have harvested the desired text & info, we download files available for each study (ex. functional annotations)
+        #this step is skipped to save time, unless it is asked with --with_downloads=True
+        if DOWNLOADS_ENABLED and not download_study_files(study, study_json):
+            print("Not all the files of study:",study,"were downloaded. They are kept in the failure ledger and the partial files will be resumed\n")
+            return
 
+        complete_study(study, study_json)
+    except Exception as error:
+        print("The study loop encountered an error: ", error ,"in study:",study,". Will empty the study folder and continue to the next study\n")
+        return
+## the harvest_study function ended here
 
 
-#########################################################################################################
-## STEP 2
-## Get the study IDs from the downloaded json files and create folders with study IDs as folder names 
-#########################################################################################################
+# harvests a study of the async engine if its check (a future of study_needs_harvest) says it is new or changed
+async def harvest_study_if_needed_async(client, study, needs_harvest):
+    if await needs_harvest:
+        await harvest_study_async(client, study)
 
-# from the json files returned in the previous block of code, keep all MGnify study IDs (i.e MGYS89342)
-study_ids_from_json = []
-
-# read one by one all the files that were downloaded from the previous step
-counter_for_study_files = 0
-for filename in os.listdir(study_list_page_json_dir):
-    # get the path for each specific file
-    file = study_list_page_json_dir + filename
-    counter_for_study_files += 1
-    # open it as a json file
-    with open(file, 'r', encoding='utf-8') as f:
-        study_list_json = json.load(f)
-    #the next comment lines are experimentation on how to access the json data in python
-    #with open(file) as f:
-    #    study_list_json = json.load(f)
-    #print("we now are in the file:", filename, "\n")
-    #print(study_list_json['data'][0], "\n\n")
-    #print(len(study_list_json['data']))
-    # for each entry in the 'data' part of the study json file:
-    for study in range(len(study_list_json['data'])):
-        studyID = study_list_json['data'][study]['id']
-        # if this ID appears for the first time, then add it on the list of studies reached
-        # and create a folder named with the ID of the study
-        if studyID not in study_ids_from_json:
-            study_ids_from_json.append(studyID)
-            study_id_dir = harv_studies + studyID
-            check_create_dir(study_id_dir)
-        else:
-            print("Found a duplicate study! (", studyID ,")\n")
-    
 
-print("Number of study page files:\t",counter_for_study_files,"\n")
-print("The number of the study ids found is: " + str(len(study_ids_from_json)) + "\n")
+# the async engine twin of harvest_study(): the same steps, with the requests sent by the async client and the study
+# files written in the executor of the event loop
+async def harvest_study_async(client, study):
+    from mgnify_async_client import run_blocking
+    try:
+        if not await run_blocking(start_study_harvest, study):
+            return
 
-#now that we got the studyID information we wanted, we are deleting the directory with the study list pages json files
-try:
-   shutil.rmtree(study_list_page_json_dir)
-   print("directory is removed successfully\n")
-except OSError as x:
-   print("Error occured: %s : %s" % (study_list_page_json_dir, x.strerror))
+        study_json = await client.get_study(study)
+        if study_json is None:
+            print("The study json could not be retrieved for study:",study,". It is kept in the failure ledger\n")
+            return
 
+        pub_json = None
+        url_publications = study_json['data']['relationships']['publications']['links']['related']
+        if url_publications:
+            pub_json = await client.get_publications(url_publications, study)
+            if pub_json is None:
+                print("The publications json could not be retrieved for study:",study,". It is kept in the failure ledger\n")
+                return
+
+        sample_pages = None
+        if SAMPLES_ENABLED:
+            sample_pages = await client.get_sample_pages(study)
+            if sample_pages is None:
+                print("Not all the sample pages of study:",study,"were retrieved. They are kept in the failure ledger\n")
+                return
+
+        await run_blocking(write_study_record, study, study_json, pub_json, sample_pages)
+
+        if DOWNLOADS_ENABLED:
+            downloads = await client.get_downloads(study_json['data']['relationships']['downloads']['links']['related'], study)
+            if downloads is None:
+                print("The downloads of study:",study,"could not be listed. They are kept in the failure ledger\n")
+                return
+            download_dir = harv_studies+study+"/downloads/"
+            await run_blocking(check_create_dir, download_dir)
+            downloaded_files = await asyncio.gather(*[client.download_file(download['links']['self'], download_dir, study)
+                                                      for download in downloads if ANALYSIS_GROUP_TYPES_TO_INCLUDE.get(download['attributes']['group-type'])])
+            print("Downloaded ", len([path for path in downloaded_files if path is not None]), " of the ", len(downloaded_files), " files of study: ", study, "\n")
+            if None in downloaded_files:
+                print("Not all the files of study:",study,"were downloaded. They are kept in the failure ledger and the partial files will be resumed\n")
+                return
+
+        await run_blocking(complete_study, study, study_json)
+    except Exception as error:
+        print("The study loop encountered an error: ", error ,"in study:",study,". Will empty the study folder and continue to the next study\n")
+        return
 
-timepoint_1 = datetime.datetime.now()
-first_step_durance = timepoint_1 - start
-print("The first and second step took: ", first_step_durance, "\n")
 
+#########################################################################################################
+## STEP 2
+## Get the study IDs from every study list page as soon as it arrives, create folders with study IDs as folder names
+## and queue the studies for STEP 3
+#########################################################################################################
 
+# from the study list pages, keep all MGnify study IDs (i.e MGYS89342) along with the last-update of every study,
+# as it is reported in the study list pages
+study_registry = StudyRegistry(harv_studies)
+studies_queued_counter = 0
+
+
+# in incremental mode only the new studies and the ones that changed upstream since their harvest are processed
+def study_needs_harvest(study):
+    if not INCREMENTAL_MODE:
+        return True
+    is_completed = os.path.exists(harv_studies+study+"/COMPLETED")
+    known_last_update = study_manifest.get(study)
+    if known_last_update is None and is_completed:
+        # harvested before the manifest existed - the last-update is in its mined_info file
+        known_last_update = read_last_update_from_mined_info(harv_studies+study+"/mined_info_"+study+".txt")
+        if known_last_update is not None:
+            with step_3_lock:
+                study_manifest[study] = known_last_update
+    if is_completed and known_last_update is not None and known_last_update == study_registry.get_last_update(study):
+        return False
+    if is_completed:
+        # the study changed upstream, without its 'COMPLETED' file it will be reset and harvested again
+        print("Study ", study, " changed upstream (", known_last_update, " -> ", study_registry.get_last_update(study), ")\n")
+        os.remove(harv_studies+study+"/COMPLETED")
+        shutil.rmtree(harv_studies+study+"/downloads/", ignore_errors = True)
+    return True
+
+
+# adds a study ID on the list of studies reached, returns False if it was already reached
+def register_study(study, last_update):
+    if not study_registry.add(study, last_update):
+        print("Found a duplicate study! (", study ,")\n")
+        return False
+    return True
+
+
+# if a study ID appears for the first time, then add it on the list of studies reached, create a folder
+# named with the ID of the study and submit it to STEP 3 (submit_study is the study executor of the engine)
+def queue_study(study, last_update, submit_study):
+    global studies_queued_counter
+    if not register_study(study, last_update):
+        return
+    if study_needs_harvest(study):
+        submit_study(study)
+        studies_queued_counter += 1
+
+
+# for each entry in the 'data' part of a study list page (parsed in memory, it is never written to disk), queue is
+# called with the study ID and its last-update (queue_study() with the study executor of the engine)
+def queue_studies_of_list_page(study_list_json, queue):
+    for study in range(len(study_list_json['data'])):
+        studyID = study_list_json['data'][study]['id']
+        queue(studyID, study_list_json['data'][study]['attributes'].get('last-update'))
 
 
 
 ##########################################################################################################################
-## STEP 3
-## Get all the text info and links we are going to need from every study and download all the downloads per study
+## STEP 1
+## Find all mgnify study list pages and stream them: every page is parsed as soon as it is downloaded (STEP 2) and its
+## studies are harvested (STEP 3) while the rest of the study list pages are still downloading
 ##########################################################################################################################
 
-study_counter = 0
-asc_study_counter = 0
+json_data = None
+study_urls = []
+if RETRY_FAILED_ONLY:
+    # only the study list pages that failed in the previous run are downloaded again
+    study_urls = [failure["url"] for failure in previous_failures if failure["key"] == "study_list"]
+    print("\nNumber of failed study data pages to be retrieved again: " + str(len(study_urls)) + "\n")
+else:
+    # this is the URL for the first page for all mgnify studies.
+    url_studies_pages=MGNIFY_REST_API_URL_BASE+"studies?page=1"
+
+    #we need to get the json variable from the above URL in order to count the study pages
+    json_data = get_json_url_with_exception_handling(url_studies_pages, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, "study_list")
+    if json_data is None:
+        print("The first study list page could not be retrieved, the number of pages is unknown. Exiting.\n")
+        sys.exit(1)
+
+    # get the total number of study pages from the json variable
+    number_of_pages = json_data['meta']['pagination']['pages']
+    print("\nNumber of study data pages to be retrieved: " + str(number_of_pages) + "\n")
+
+    # get all the study URLs in a list - We manipulate the nr in the "while counter < page_limiter" to test the script
+    # the first page is already in memory, so the list starts from the second one
+    counter = 1
+    page_limiter = number_of_pages   #will iterate though all the study pages
+    if DEVELOPMENT_MODE_ENABLED==True:
+        page_limiter = NUMBER_OF_STUDY_PAGES_LIMIT
+    while counter < page_limiter :
+        counter += 1
+        page_url= MGNIFY_REST_API_URL_BASE+"studies?page=" + str(counter)
+        study_urls.append(page_url)
+
+
+# prints the totals of STEP 1 and STEP 2, once all the study list pages were streamed
+def summarize_study_list_step(failed_study_list_pages):
+    global timepoint_1
+    print("Number of study list pages that permanently failed:\t",failed_study_list_pages,"\n")
+    print("The number of the study ids found is: " + str(len(study_registry)) + "\n")
+    if INCREMENTAL_MODE:
+        print("Incremental mode: ", studies_queued_counter, " of the ", len(study_registry), " studies are new or changed\n")
+
+    timepoint_1 = datetime.datetime.now()
+    first_step_durance = timepoint_1 - start
+    print("All the study list pages were streamed, this took: ", first_step_durance, "\n")
+    summarize_request_metrics("study_list")
+
+
+# the async engine: the study list pages and the studies are all tasks of one event loop, the async client keeps at
+# most ASYNC_CONCURRENCY requests in flight and shares the rate limiter, the failure ledger and the cache of the threads engine
+async def run_async_engine():
+    global studies_queued_counter
+    from mgnify_async_client import MGnifyAsyncClient, run_blocking
+    client = MGnifyAsyncClient(MGNIFY_REST_API_URL_BASE, ASYNC_CONCURRENCY, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
+    needs_harvest_checks = []
+    study_tasks = []
+
+    # the async twin of queue_study(): study_needs_harvest() reads (and may reset) the study folder, so it runs in the
+    # executor and the study is harvested once it is checked
+    def queue_study_async(study, last_update):
+        if not register_study(study, last_update):
+            return
+        needs_harvest = asyncio.ensure_future(run_blocking(study_needs_harvest, study))
+        needs_harvest_checks.append(needs_harvest)
+        study_tasks.append(asyncio.ensure_future(harvest_study_if_needed_async(client, study, needs_harvest)))
 
-# for each study ID of those recorded we will gather the desired information
-for study in study_ids_from_json:
     try:
-        #adding a separator for reading comfort
-        print("=================================================================================================================\n")
-        
-        
-        #checking if the file COMPLETED exists and if the study is already harvested
-        isExist = os.path.exists(harv_studies+study+"/COMPLETED")
-        if isExist:
-            print("File 'COMPLETED' found in study with ID: ",study,". Will continue to the next study\n")
-            continue
-        else:
-            print("File 'COMPLETED' NOT found in study with ID: ",study,"\n")
-            print("Directory reset: ", harv_studies+study ,"\n")
-            remove_dir(harv_studies+study) 
-            
-
-
-        #create a file to write all the info we want to extract
-        f = open(harv_studies+study+"/mined_info_"+study+".txt", "w", encoding='utf-8')  
-        
-    
-        #we are keeping track of how many studies have been harvested so far
-        study_counter += 1
-        print("We are in study nr",study_counter," with study ID: ",study, "\n")
-
-        # read the page of every study from the id's obtained in json format
-        url=MGNIFY_REST_API_URL_BASE+"studies/" + study
-        # check if the page was open 
-        
-
-        #we need to define an empty variable that will contain the json to import as argument in the next method
-        study_json = get_json_url_with_exception_handling(url, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
-        
-        
-
-        # extract the desired information from the obtained json variable
-        # create a file and write all the desired data
-        #printing basic attributes to file
-        attribute = ''
-        attribute = study_json['data']['id']
-        f.write("study_id\t"+attribute+"\n")
-        attribute = study_json['data']['attributes']['study-name']
-        cleaned_study_name = clean_text(attribute)
-        f.write("study_name\t"+cleaned_study_name+"\n")
-        attribute = study_json['data']['attributes']['study-abstract']
-        cleaned_study_abstract = clean_text(attribute)
-        #cleaned_abstract = re.sub(r'\s+', ' ', attribute)
-        #cleaned_abstract = attribute.replace('\n', ' ')
-        #cleaned_abstract_rstriped = cleaned_abstract.rstrip()
-        f.write("study_abstract\t"+cleaned_study_abstract+"\n")
-        attribute = study_json['data']['attributes']['data-origination']
-        f.write("study_origination\t"+attribute+"\n")
-        attribute = study_json['data']['attributes']['bioproject']
-        if attribute:
-            f.write("study_bioproject_id\t"+attribute+"\n")
-        else: 
-            f.write("study_bioproject_id\tunavailable\n")
-        attribute = study_json['data']['attributes']['secondary-accession']
-        f.write("study_secondary_acession\t"+attribute+"\n")
-        attribute = study_json['data']['attributes']['last-update']
-        f.write("study_last_update\t"+attribute+"\n")
-        #printing associated studies (if any) to file
-        for asc_study in range(len(study_json['data']['relationships']['studies']['data'])):
-            f.write("associated_study_"+str(asc_study)+"\t"+study_json['data']['relationships']['studies']['data'][asc_study]['id']+"\n")
-            asc_study_counter += 1
-        #printing associated biomes to file
-        for biome in range(len(study_json['data']['relationships']['biomes']['data'])):
-            f.write("biome_info_"+str(biome)+"\t"+study_json['data']['relationships']['biomes']['data'][biome]['id']+"\n")
-        
-        
-        f.write("=========================================================================================\n")
+        for failure in previous_failures:
+            if failure["key"] != "study_list":
+                queue_study_async(failure["key"], None)
+
+        if json_data is not None:
+            queue_studies_of_list_page(json_data, queue_study_async)
+
+        failed_study_list_pages = 0
+        for page_task in asyncio.as_completed([client.get_json(url, "study_list") for url in study_urls]):
+            study_list_json = await page_task
+            if study_list_json is None:
+                failed_study_list_pages += 1
+                continue
+            queue_studies_of_list_page(study_list_json, queue_study_async)
+        # the queued studies are counted once all of them are checked
+        if needs_harvest_checks:
+            await asyncio.wait(needs_harvest_checks)
+        studies_queued_counter += sum(1 for needs_harvest in needs_harvest_checks if needs_harvest.result())
+        summarize_study_list_step(failed_study_list_pages)
+
+        # the studies queued by the last pages are harvested here
+        await asyncio.gather(*study_tasks)
+    finally:
+        await client.close()
+
+
+print("The study executor is about to start. \n" + str(datetime.datetime.now()))
+if ENGINE == "async":
+    print("The async engine just started, with up to ", ASYNC_CONCURRENCY, " requests in flight! \n")
+    asyncio.run(run_async_engine())
+else:
+    # Two executors, built thanks to the concurrent.futures package, using the number of threads you want to: the study list
+    # executor downloads the study list pages and, as every page arrives, its studies are submitted to the study executor
+    failed_study_list_pages = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = int(NUM_OF_THREADS)) as study_executor:
+        print("The executor for harvesting the studies just started! \n")
+        submit_study = lambda study: study_executor.submit(harvest_study, study)
+        queue_study_of_page = lambda study, last_update: queue_study(study, last_update, submit_study)
+
+        # when re-driving the failure ledger, the studies that failed in the previous run are harvested again
+        for failure in previous_failures:
+            if failure["key"] != "study_list":
+                queue_study(failure["key"], None, submit_study)
+
+        if json_data is not None:
+            queue_studies_of_list_page(json_data, queue_study_of_page)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = int(NUM_OF_THREADS)) as list_executor:
+            print("The executor for downloading studies list pages just started! \n")
+            # every page gets its full round of attempts, the pages that still fail are kept in the failure ledger
+            future_to_url = {list_executor.submit(get_json_url_with_exception_handling, url, 15, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT, "study_list"): url for url in study_urls}
+            for future in concurrent.futures.as_completed(future_to_url):
+                study_list_json = future.result()
+                if study_list_json is None:
+                    failed_study_list_pages += 1
+                    continue
+                queue_studies_of_list_page(study_list_json, queue_study_of_page)
+
+        summarize_study_list_step(failed_study_list_pages)
+    ## the study executor waits here for all the queued studies to be harvested
+
+if sample_page_executor is not None:
+    sample_page_executor.shutdown()
+if download_executor is not None:
+    download_executor.shutdown()
 
-        #now we need to access other attributes like "publications" which are in a new json.
-        #we get the link for "publications" like this:
-        url_publications = study_json['data']['relationships']['publications']['links']['related']
-        if url_publications:
-            pub_json = get_json_url_with_exception_handling(url_publications, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
-
-            #print("type:",type(pub_json['data']),"\n")
-            #print("Printing json keys :",pub_json.keys(),"\n")
-            for publication in range(len(pub_json['data'])):
-                #print("i is: ", publication, "\n")
-                pub_attribute = pub_json['data'][publication]['attributes']['pubmed-id']
-                studyid_pmid_file_handler.write(study+"\t"+str(pub_attribute)+"\n")
-
-                #print("The type is: ", type(pub_attribute), "\n")
-                f.write("publication_nr_"+str(publication)+"_pubmed_id\t"+str(pub_attribute)+"\n")
-                pub_attribute = pub_json['data'][publication]['attributes']['pub-title']
-                f.write("publication_nr_"+str(publication)+"_title\t"+str(pub_attribute)+"\n")
-                pub_attribute = pub_json['data'][publication]['attributes']['published-year']
-                f.write("publication_nr_"+str(publication)+"_publication_year\t"+str(pub_attribute)+"\n")
-
-            f.write("=========================================================================================\n")
-        else:
-            f.write("Publications unavailable from the server\n")
-            f.write("=========================================================================================\n")
-
-
-        """
-        #we get the link for "samples" like this:
-        #url_samples = study_json['data']['relationships']['samples']['links']['related']
-        url_samples = MGNIFY_REST_API_URL_BASE+'studies/'+study+'/samples?page=1'
-        
-        
-        #geting the page info for samples
-        json_data_samples = get_json_url_with_exception_handling(url_samples, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
-
-        # get the total number of pages 
-        number_of_pages = json_data_samples['meta']['pagination']['pages']
-        print("Number of sample pages to be retrieved from "+study+": " + str(number_of_pages) + "\n")
-
-
-        #going through all sample pages
-        sample_nr = 0
-        for i in range (int(number_of_pages)):
-            
-            
-            page_nr = i+1
-            
-            if page_nr == 1 : 
-                sam_json = json_data_samples.copy()
-            else:
-                url_samples = MGNIFY_REST_API_URL_BASE+'studies/'+study+'/samples?page='+str(page_nr)
-                sam_json = get_json_url_with_exception_handling(url_samples, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)
-            #for every sample page we get the json and extract info
-            for sample in range(len(sam_json['data'])):
-                sam_attribute = sam_json['data'][sample]['attributes']['accession']
-                f.write("sample_nr_"+str(sample_nr)+"_sample_id\t"+str(sam_attribute)+"\n")
-                sam_attribute = sam_json['data'][sample]['attributes']['sample-desc']
-                if sam_attribute:
-                    cleaned_sample_desc = clean_text(sam_attribute)
-                    f.write("sample_nr_"+str(sample_nr)+"_sample_description\t"+str(cleaned_sample_desc)+"\n")
-                else:
-                    cleaned_sample_desc = "unavailable"
-                    f.write("sample_nr_"+str(sample_nr)+"_sample_description\t"+cleaned_sample_desc+"\n")
-                
-                sample_nr += 1         
-             
-        
-            #print("The page nr is:",page_nr,"\n")
-        
-        print("Total number of sample pages retrieved:",page_nr,"\n")
-        print("Total number of samples:",sample_nr,"\n")
-        f.write("\n")
-        """
-        #after the data extraction is completed we close the file for this study inside the loop
-        f.close()
-        
-        
-        #after we have harvested the desired text & info, we download files available for each study (ex. functional annotations)
-        
-        
-        
-        #will skip this step to save time
-        
-        #we get the link for "downloads" like this:
-        
-        
-        
-        """
-        url_downloads = study_json['data']['relationships']['downloads']['links']['related']
-        
-        
-        dwn_json = get_json_url_with_exception_handling(url_downloads, 30, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT) 
-             
-        #before downloading we clear the download path from previous .tsv files, so as not to get altered filenames
-        # like GO-slim_abundances_v5.0 (1).tsv
-        dir_name = harv_studies+study
-        test = os.listdir(dir_name)
-        for item in test:
-            if item.endswith(".tsv"):
-                os.remove(os.path.join(dir_name, item))
-                
 
-        #now we go though every download link in the study
-        for download in range(len(dwn_json['data'])):
-            #print("i is: ", publication, "\n")
-            dwn_url = dwn_json['data'][download]['links']['self']
-            #print("The group type is: ", dwn_json['data'][download]['attributes']['group-type'], "\n")
-            #group_type = dwn_json['data'][download]['attributes']['group-type']
-            #if ANALYSIS_GROUP_TYPES_TO_INCLUDE.get(group_type):
-                #get the info if we want it
-            #and now we can download the files
-            download_file_via_wget_url(dwn_url, harv_studies+study, float(SLEEP_MIN), float(SLEEP_MAX), RECURSIONS_LIMIT)\
-        
-        """
-        
-        #now creating the 'COMPLETED' file
-        completion_file = open(harv_studies+study+"/COMPLETED", "w", encoding='utf-8')
-        completion_file.close()
-        print("File 'COMPLETED' created\n")
-    except Exception as error:
-        print("The study loop encountered an error: ", error ,"in study:",study,". Will empty the study folder and continue to the next study\n")
-        continue
-## the for study in study_ids_from_json ended here         
-        
-    
 studyid_pmid_file_handler.close        
+pmid_study_counter.close()
+save_study_manifest(study_manifest_full_path, study_manifest)
+print("The study manifest was saved: ", study_manifest_full_path, " (", len(study_manifest), " studies)\n")
+finalize_failure_ledger(failure_ledger_full_path)
+print("The failure ledger was saved: ", failure_ledger_full_path, "\n")
 print("=================================================================================================================\n")     
 
 #for every incomplete study we empty its directory, so it can be downloaded again, clean
@@ -481,10 +678,12 @@ print("The total nr of harvested/checked studies are:", study_counter, "\n")
 
 timepoint_2 = datetime.datetime.now()
 third_step_durance = timepoint_2 - timepoint_1
-print("The third step took: ", third_step_durance, "\n")
+print("The harvest of the studies still running after the study list took: ", third_step_durance, "\n")
 
 
-total_durance = timepoint_2 - start
-print("Total runtime: ", total_durance)
+summarize_request_metrics("study_harvest")
+if DOWNLOADS_ENABLED:
+    summarize_request_metrics("downloads")
 
-log_file.close()
\ No newline at end of file
+total_durance = timepoint_2 - start
+print("Total runtime: ", total_durance)
\ No newline at end of file
@@ -0,0 +1,278 @@
+#!/usr/bin/python3.5
+
+########################################################################################
+# script name: mgnify_async_client.py
+# framework: CCMRI
+########################################################################################
+# GOAL
+# An asyncio client for the MGnify API, the alternative engine of get_mgnify_via_studyID.py (--engine=async).
+# Instead of one blocking request per thread, thousands of requests can be in flight from a single thread.
+# It covers the same endpoints as the thread engine: study list pages, studies, publications, samples and downloads.
+# The client shares with mgnify_functions.py the token bucket rate limiter, the retry policies and the failure ledger,
+# the response cache and the per-request JSON log, so both engines behave (and are logged) the same way.
+# The blocking work of a request (the response cache, the failure ledger and every file operation of the downloads) runs
+# in the default executor of the event loop, so that it never stalls the other requests in flight (the per-request log
+# goes through the logging queue, it does not block either).
+# It needs the aiohttp package (pip install aiohttp), which is only imported when the async engine is selected.
+########################################################################################
+
+
+import asyncio, json, os, time
+
+from mgnify_functions import try_take_rate_limit_token, update_rate_limit, log_request, RETRY_POLICIES, get_backoff_seconds, \
+    classify_status_code, record_failure, read_cached_response, write_cached_response, url_calls_logger, DEEP_LOG
+import mgnify_functions
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+#waits (without blocking the event loop) for a token of the shared rate limiter, returns the seconds spent waiting
+async def wait_for_rate_limit_async():
+    waited = 0.0
+    while True:
+        wait = try_take_rate_limit_token()
+        if wait == 0:
+            return waited
+        await asyncio.sleep(wait)
+        waited += wait
+
+
+#runs a blocking function (file or SQLite I/O) in the default executor of the event loop and returns its result
+async def run_blocking(function, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+#the file operations of download_file(), run in the executor:
+#the size of the partial file of a download (0 if there is none) and the etag it was downloaded with (None if unknown)
+def read_partial_download(part_path, etag_path):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    etag = None
+    if os.path.exists(etag_path):
+        with open(etag_path, "r", encoding='utf-8') as etag_file:
+            etag = etag_file.read().strip() or None
+    return offset, etag
+
+
+#keeps the etag of the response (if any) and opens the partial file, to append to it ("ab") or to start it over ("wb")
+def open_partial_download(part_path, etag_path, mode, etag):
+    if etag:
+        with open(etag_path, "w", encoding='utf-8') as etag_file:
+            etag_file.write(etag)
+    return open(part_path, mode)
+
+
+#renames the partial file to the final one if it has the expected size (unknown: any size), a partial file bigger than
+#expected is discarded. Returns the size of the partial file and whether the download is complete
+def finish_partial_download(part_path, final_path, etag_path, expected_size):
+    downloaded_size = os.path.getsize(part_path)
+    if expected_size is None or downloaded_size == expected_size:
+        os.replace(part_path, final_path)
+        if os.path.exists(etag_path):
+            os.remove(etag_path)
+        return downloaded_size, True
+    if downloaded_size > expected_size:
+        os.remove(part_path)
+    return downloaded_size, False
+
+
+def classify_async_exception(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, aiohttp.TooManyRedirects):
+        return "bad_url"
+    if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return "connection_error"
+    return "other"
+
+
+class MGnifyAsyncClient:
+
+    #concurrency is the maximum number of requests in flight, the other arguments are the ones of the thread engine
+    def __init__(self, base_url, concurrency, timeout_in_sec, sleep_min, sleep_max, max_attempts):
+        if aiohttp is None:
+            raise ImportError("The async engine needs the aiohttp package: pip install aiohttp")
+        self.base_url = base_url
+        self.timeout_in_sec = timeout_in_sec
+        self.sleep_min = sleep_min
+        self.sleep_max = sleep_max
+        self.max_attempts = max_attempts
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # one connection pool for the whole client, as big as the number of requests in flight
+        self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = concurrency),
+                                             headers = {"Accept-Encoding": "gzip, deflate"})
+
+    async def close(self):
+        await self.session.close()
+
+    #the retry engine of the async client: same policies, backoff and failure ledger as fetch_with_retry().
+    #The body is read whole and then parsed, as in the threads engine. Returns the json (None if it permanently failed)
+    async def get_json(self, url, ledger_key = None):
+        if DEEP_LOG:
+            url_calls_logger.debug(json.dumps({"check": "MGnifyAsyncClient.get_json", "url": url, "limiter": self.max_attempts}))
+
+        cached = await run_blocking(read_cached_response, url)
+        if mgnify_functions.RESPONSE_CACHE_OFFLINE:
+            if cached is not None:
+                return json.loads(cached[1].decode("utf-8"))
+            await run_blocking(record_failure, url, "offline_miss", "not in the response cache", 0, ledger_key)
+            return None
+        conditional_headers = {}
+        if cached is not None:
+            if cached[0].get("etag"):
+                conditional_headers["If-None-Match"] = cached[0]["etag"]
+            if cached[0].get("last_modified"):
+                conditional_headers["If-Modified-Since"] = cached[0]["last_modified"]
+
+        error_class, error = "other", "no attempt was made"
+        step = "study_list" if ledger_key == "study_list" else "study_harvest"
+        backoff = 0.0
+        attempt = 0
+        while attempt < self.max_attempts:
+            attempt += 1
+            async with self.semaphore:
+                slept = backoff + await wait_for_rate_limit_async()
+                request_start = time.monotonic()
+                status, body, request_error = None, None, None
+                try:
+                    async with self.session.get(url, headers = conditional_headers, timeout = aiohttp.ClientTimeout(total = self.timeout_in_sec)) as response:
+                        status = response.status
+                        update_rate_limit(response.status, response.headers)
+                        body = await response.read()
+                        headers = response.headers
+                except Exception as exception:
+                    request_error = str(exception)
+                    error_class, error = classify_async_exception(exception), exception
+                log_request(step, url, status, len(body) if body is not None else None, time.monotonic() - request_start, attempt, slept, request_error)
+
+            if status == 304 and cached is not None:
+                return json.loads(cached[1].decode("utf-8"))
+            if status is not None:
+                status_error = classify_status_code(status)
+                if status_error is None:
+                    try:
+                        json_data = json.loads(body.decode("utf-8"))
+                        await run_blocking(write_cached_response, url, headers, body)
+                        return json_data
+                    except ValueError as json_error:
+                        status_error = "invalid_json", json_error
+                error_class, error = status_error
+            print("Attempt ", attempt, " of ", self.max_attempts, " failed - ", error_class, ": ", error, " - while downloading URL: ", url, "\n")
+            if not RETRY_POLICIES[error_class]["retry"] or attempt == self.max_attempts:
+                break
+            backoff = get_backoff_seconds(error_class, attempt, self.sleep_min, self.sleep_max)
+            await asyncio.sleep(backoff)
+        await run_blocking(record_failure, url, error_class, error, attempt, ledger_key)
+        return None
+
+    async def get_study(self, study):
+        return await self.get_json(self.base_url + "studies/" + study, study)
+
+    async def get_publications(self, url_publications, study):
+        return await self.get_json(url_publications, study)
+
+    #all the sample pages of a study, in page order: the first page reveals the number of pages, the rest are fetched
+    #concurrently. Returns None if not all the pages were retrieved
+    async def get_sample_pages(self, study):
+        url_samples = self.base_url + "studies/" + study + "/samples?page="
+        json_data_samples = await self.get_json(url_samples + "1", study)
+        if json_data_samples is None:
+            return None
+        number_of_pages = int(json_data_samples['meta']['pagination']['pages'])
+        sample_pages = [json_data_samples] + list(await asyncio.gather(*[self.get_json(url_samples + str(page_nr), study) for page_nr in range(2, number_of_pages + 1)]))
+        if None in sample_pages:
+            return None
+        return sample_pages
+
+    #all the entries of the downloads of a study (every page of them). Returns None if not all the pages were retrieved
+    async def get_downloads(self, url_downloads, study):
+        json_data_downloads = await self.get_json(url_downloads + "?page=1", study)
+        if json_data_downloads is None:
+            return None
+        number_of_pages = 1
+        if 'meta' in json_data_downloads and json_data_downloads['meta'].get('pagination'):
+            number_of_pages = int(json_data_downloads['meta']['pagination']['pages'])
+        download_pages = [json_data_downloads] + list(await asyncio.gather(*[self.get_json(url_downloads + "?page=" + str(page_nr), study) for page_nr in range(2, number_of_pages + 1)]))
+        if None in download_pages:
+            return None
+        return [download for page in download_pages for download in page['data']]
+
+    #the async twin of download_file_with_resume(): <filename>.part, Range/If-Range resume, size check, atomic rename.
+    #Every file operation runs in the executor. There is no total timeout, a large file may take hours: the connection
+    #and every read of the body have the timeout of the client instead.
+    #Returns the path of the downloaded file (None if every attempt failed - the url is then kept in the failure ledger)
+    async def download_file(self, url, path_to_save, ledger_key = None):
+        filename = url.split("?")[0].rstrip("/").split("/")[-1]
+        final_path = os.path.join(path_to_save, filename)
+        part_path = final_path + ".part"
+        etag_path = part_path + ".etag"
+        if await run_blocking(os.path.exists, final_path):
+            print("The file is already downloaded:", filename, "\n")
+            return final_path
+        timeout = aiohttp.ClientTimeout(total = None, sock_connect = self.timeout_in_sec, sock_read = self.timeout_in_sec)
+
+        error_class, error = "other", "no attempt was made"
+        backoff = 0.0
+        attempt = 0
+        while attempt < self.max_attempts:
+            attempt += 1
+            async with self.semaphore:
+                slept = backoff + await wait_for_rate_limit_async()
+                request_start = time.monotonic()
+                status, number_of_bytes, request_error = None, None, None
+                try:
+                    offset, etag = await run_blocking(read_partial_download, part_path, etag_path)
+                    headers = {"Accept-Encoding": "identity"}
+                    if offset > 0:
+                        headers["Range"] = "bytes={}-".format(offset)
+                        if etag:
+                            headers["If-Range"] = etag
+                    async with self.session.get(url, headers = headers, auto_decompress = False, timeout = timeout) as response:
+                        status = response.status
+                        update_rate_limit(response.status, response.headers)
+                        if status == 416:
+                            await run_blocking(os.remove, part_path)
+                            error_class, error = "incomplete_file", "HTTP 416 - the partial file was discarded"
+                        elif status in (200, 206):
+                            expected_size = None
+                            if status == 206:
+                                mode = "ab"
+                                content_range = response.headers.get("Content-Range", "")
+                                if "/" in content_range and content_range.split("/")[-1] != "*":
+                                    expected_size = int(content_range.split("/")[-1])
+                            else:
+                                mode = "wb"
+                                if response.headers.get("Content-Length"):
+                                    expected_size = int(response.headers["Content-Length"])
+                            number_of_bytes = 0
+                            part_file = await run_blocking(open_partial_download, part_path, etag_path, mode, response.headers.get("ETag"))
+                            try:
+                                async for chunk in response.content.iter_chunked(1024 * 1024):
+                                    await run_blocking(part_file.write, chunk)
+                                    number_of_bytes += len(chunk)
+                            finally:
+                                await run_blocking(part_file.close)
+                            downloaded_size, complete = await run_blocking(finish_partial_download, part_path, final_path, etag_path, expected_size)
+                            if complete:
+                                error_class = None
+                            else:
+                                error_class, error = "incomplete_file", "got {} of {} bytes".format(downloaded_size, expected_size)
+                        else:
+                            error_class, error = classify_status_code(status)
+                except Exception as exception:
+                    request_error = str(exception)
+                    error_class, error = classify_async_exception(exception), exception
+                log_request("downloads", url, status, number_of_bytes, time.monotonic() - request_start, attempt, slept, request_error)
+
+            if error_class is None:
+                print("The file was downloaded:", filename, "(", downloaded_size, "bytes )\n")
+                return final_path
+            print("Attempt ", attempt, " of ", self.max_attempts, " failed - ", error_class, ": ", error, " - while downloading file: ", url, "\n")
+            if not RETRY_POLICIES[error_class]["retry"] or attempt == self.max_attempts:
+                break
+            backoff = get_backoff_seconds(error_class, attempt, self.sleep_min, self.sleep_max)
+            await asyncio.sleep(backoff)
+        await run_blocking(record_failure, url, error_class, error, attempt, ledger_key)
+        return None
@@ -14,19 +14,61 @@
 
 
 
-import time, datetime, random
-import json, re, os, sys, traceback, glob
+import time, datetime, random, threading
+import logging, logging.handlers, queue
+import json, re, os, sys, traceback, glob, hashlib, sqlite3
 import asyncio, concurrent.futures
-import requests, wget, urllib
+import requests, urllib
 from requests.exceptions import Timeout
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 import http.client
+import email.utils
+from collections import OrderedDict
+from requests.structures import CaseInsensitiveDict
 from bs4 import BeautifulSoup
 import re
 
 DEEP_LOG = True
 
+#logging goes through a queue: the threads only put their records (and what they print, when sys.stdout is a
+#QueueLoggingStream) in the queue and a single listener thread writes them to the log files, so that no thread waits
+#on the disk. Every request is logged as a JSON line to the url calls log (url, status, bytes, latency, retries, sleep).
+stdout_logger = logging.getLogger("mgnify.stdout")
+url_calls_logger = logging.getLogger("mgnify.url_calls")
+
+#per-request metrics, kept per step ("study_list", "study_harvest", "downloads"), for the summaries printed at the end of each step
+request_metrics = {}
+request_metrics_lock = threading.Lock()
+
+#all the fetch helpers share one pooled HTTP session, so that the connections to the EBI server are kept alive and reused
+#instead of paying a new TCP+TLS handshake for every page. The pool size should match the number of threads of the caller.
+HTTP_POOL_SIZE = 5
+http_session = None
+http_session_lock = threading.Lock()
+
+#the JSON answers of the server are kept in an on-disk response cache (one body and one metadata file per url, named by
+#the sha1 of the url). A cached url is revalidated with a conditional GET (If-None-Match/If-Modified-Since) and a 304
+#answer is served from the cache. The cache is bounded to RESPONSE_CACHE_MAX_BYTES, the least recently used entries
+#are evicted first. In offline mode nothing is asked from the server, the answers come only from the cache.
+RESPONSE_CACHE_DIR = None
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+RESPONSE_CACHE_OFFLINE = False
+response_cache_size = 0
+response_cache_lock = threading.Lock()
+
+#politeness towards the EBI server is enforced by a global token bucket shared by all the threads: at most
+#RATE_LIMIT_PER_SEC requests per second on average, with up to RATE_LIMIT_BURST requests sent back to back.
+#When the server answers 429/503 the rate is halved (and a Retry-After header pauses everybody), then it slowly recovers.
+RATE_LIMIT_PER_SEC = 2.0
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_MIN_PER_SEC = 0.1
+rate_limit_current_rate = RATE_LIMIT_PER_SEC
+rate_limit_tokens = float(RATE_LIMIT_BURST)
+rate_limit_last_refill = time.monotonic()
+rate_limit_paused_until = 0.0
+rate_limit_lock = threading.Lock()
+
 #checks if a directory exists and creates it if it doesn't exist
 def check_create_dir(dir):
     isExist = os.path.exists(dir)
@@ -35,15 +77,255 @@ def check_create_dir(dir):
         os.makedirs(dir)
 
 
+#removes the files of a directory - sub-directories (i.e. the downloads of a study) are kept
 def remove_dir(dir):
     filelist = glob.glob(os.path.join(dir, "*"))
     for f in filelist:
-        os.remove(f)
+        if os.path.isfile(f):
+            os.remove(f)
+
+
+#a file-like object to replace sys.stdout: whatever is printed becomes a record of the stdout logger (and goes to the queue)
+#print() writes its arguments and separators one by one, so the text is buffered (per thread, the threads print concurrently)
+#and every complete line becomes one record
+class QueueLoggingStream:
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+
+    def write(self, text):
+        if text:
+            thread_id = threading.get_ident()
+            with self.buffers_lock:
+                buffered = self.buffers.pop(thread_id, "") + text
+                end_of_lines = buffered.rfind("\n") + 1
+                if end_of_lines < len(buffered):
+                    self.buffers[thread_id] = buffered[end_of_lines:]
+            if end_of_lines:
+                self.logger.info(buffered[:end_of_lines])
+        return len(text)
+
+    #writes the unfinished lines of all the threads (at the end of the run, nothing is left behind)
+    def flush(self):
+        with self.buffers_lock:
+            remainders = list(self.buffers.values())
+            self.buffers.clear()
+        for remainder in remainders:
+            self.logger.info(remainder)
+
+
+#starts the queue-backed logging pipeline: the stdout logger writes (unchanged) to log_file_name and the url calls logger
+#writes JSON lines to url_calls_log_file_name. Returns the listener, it must be stopped (stop_queue_logging) at the end
+def start_queue_logging(log_file_name, url_calls_log_file_name):
+    log_queue = queue.Queue(-1)
+
+    stdout_handler = logging.FileHandler(log_file_name, mode = "w", encoding = "utf-8")
+    stdout_handler.terminator = ""    #print() already writes its own newlines
+    stdout_handler.setFormatter(logging.Formatter("%(message)s"))
+    stdout_handler.addFilter(logging.Filter(stdout_logger.name))
+
+    url_calls_handler = logging.FileHandler(url_calls_log_file_name, mode = "w", encoding = "utf-8")
+    url_calls_handler.setFormatter(logging.Formatter("%(message)s"))
+    url_calls_handler.addFilter(logging.Filter(url_calls_logger.name))
+
+    for logger in (stdout_logger, url_calls_logger):
+        logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, stdout_handler, url_calls_handler)
+    listener.start()
+    return listener
+
+
+#writes whatever is still in the queue and closes the log files
+def stop_queue_logging(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def record_request_metrics(step, latency, number_of_bytes, failed, attempt, slept):
+    with request_metrics_lock:
+        if step not in request_metrics:
+            request_metrics[step] = {"latencies": [], "bytes": 0, "errors": 0, "retries": 0, "sleep": 0.0, "start": time.monotonic()}
+        metrics = request_metrics[step]
+        metrics["latencies"].append(latency)
+        metrics["bytes"] += number_of_bytes or 0
+        metrics["errors"] += 1 if failed else 0
+        metrics["retries"] += 1 if attempt > 1 else 0
+        metrics["sleep"] += slept
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(percentile * (len(sorted_values) - 1)))]
+
+
+#prints (and logs as a JSON line) the request summary of a step: number of requests, p50/p95 latency, requests/second
+def summarize_request_metrics(step):
+    with request_metrics_lock:
+        metrics = request_metrics.get(step)
+        if metrics is None:
+            print("No requests were made in step: ", step, "\n")
+            return None
+        latencies = sorted(metrics["latencies"])
+        elapsed = time.monotonic() - metrics["start"]
+        summary = OrderedDict([
+            ("summary", step),
+            ("requests", len(latencies)),
+            ("errors", metrics["errors"]),
+            ("retries", metrics["retries"]),
+            ("bytes", metrics["bytes"]),
+            ("latency_p50_sec", round(get_percentile(latencies, 0.50), 3)),
+            ("latency_p95_sec", round(get_percentile(latencies, 0.95), 3)),
+            ("requests_per_sec", round(len(latencies) / elapsed, 3) if elapsed > 0 else 0.0),
+            ("sleep_sec", round(metrics["sleep"], 3)),
+            ("elapsed_sec", round(elapsed, 3)),
+        ])
+    url_calls_logger.info(json.dumps(summary))
+    print("Requests summary of step ", step, ": ", json.dumps(summary), "\n")
+    return summary
+
+
+#sets the size of the connection pool of the shared session (i.e. to NUM_OF_THREADS) - the session is rebuilt on its next use
+def configure_http_session(pool_size):
+    global HTTP_POOL_SIZE, http_session
+    with http_session_lock:
+        HTTP_POOL_SIZE = int(pool_size)
+        if http_session is not None:
+            http_session.close()
+        http_session = None
+
+
+#returns the shared session, creating it on the first call. The session is created once under a lock and then shared by
+#all the threads, the HTTPAdapter keeps up to HTTP_POOL_SIZE open connections per host
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = HTTP_POOL_SIZE, pool_maxsize = HTTP_POOL_SIZE, pool_block = True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            http_session = session
+        return http_session
+
+
+#sets the allowed aggregate request rate (requests/second over all the threads) and the burst allowance
+def configure_rate_limiter(requests_per_sec, burst):
+    global RATE_LIMIT_PER_SEC, RATE_LIMIT_BURST, rate_limit_current_rate, rate_limit_tokens, rate_limit_last_refill
+    with rate_limit_lock:
+        RATE_LIMIT_PER_SEC = float(requests_per_sec)
+        RATE_LIMIT_BURST = max(1, int(burst))
+        rate_limit_current_rate = RATE_LIMIT_PER_SEC
+        rate_limit_tokens = float(RATE_LIMIT_BURST)
+        rate_limit_last_refill = time.monotonic()
+
+
+#takes a token from the bucket if there is one and returns 0, otherwise returns the seconds to wait before trying again
+#(it never blocks, so that both the threads and the asyncio engine can share the same bucket)
+def try_take_rate_limit_token():
+    global rate_limit_tokens, rate_limit_last_refill
+    with rate_limit_lock:
+        now = time.monotonic()
+        rate_limit_tokens = min(float(RATE_LIMIT_BURST), rate_limit_tokens + (now - rate_limit_last_refill) * rate_limit_current_rate)
+        rate_limit_last_refill = now
+        if now >= rate_limit_paused_until and rate_limit_tokens >= 1:
+            rate_limit_tokens -= 1
+            return 0
+        return max(rate_limit_paused_until - now, (1 - rate_limit_tokens) / rate_limit_current_rate)
+
+
+#blocks the calling thread until the token bucket allows one more request, returns the seconds spent waiting
+def wait_for_rate_limit():
+    waited = 0.0
+    while True:
+        wait = try_take_rate_limit_token()
+        if wait == 0:
+            return waited
+        time.sleep(wait)
+        waited += wait
+
+
+#returns the seconds asked by a Retry-After header (either delay-seconds or an HTTP date), None if there is no usable header
+def get_retry_after_seconds(headers):
+    retry_after = headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_date - datetime.datetime.now(retry_date.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+#adapts the token bucket to the answer of the server (status code and headers): 429/503 halve the rate and honor
+#Retry-After, anything else lets the rate climb back (additively) towards RATE_LIMIT_PER_SEC
+def update_rate_limit(status_code, headers):
+    global rate_limit_current_rate, rate_limit_paused_until
+    with rate_limit_lock:
+        if status_code in (429, 503):
+            rate_limit_current_rate = max(RATE_LIMIT_MIN_PER_SEC, rate_limit_current_rate / 2)
+            retry_after = get_retry_after_seconds(headers)
+            if retry_after is None:
+                retry_after = 1 / rate_limit_current_rate
+            rate_limit_paused_until = max(rate_limit_paused_until, time.monotonic() + retry_after)
+            print("The server answered ", status_code, " - slowing down to ", rate_limit_current_rate, " requests/sec for at least ", retry_after, " seconds\n")
+        elif rate_limit_current_rate < RATE_LIMIT_PER_SEC:
+            rate_limit_current_rate = min(RATE_LIMIT_PER_SEC, rate_limit_current_rate + RATE_LIMIT_PER_SEC / 20)
+
+
+#counts a request in the metrics of its step and logs it as a JSON line to the url calls log
+def log_request(step, url, status, number_of_bytes, latency, attempt, slept, error):
+    record_request_metrics(step, latency, number_of_bytes, status is None or status >= 400, attempt, slept)
+    url_calls_logger.debug(json.dumps(OrderedDict([
+        ("time", str(datetime.datetime.now())),
+        ("step", step),
+        ("url", url),
+        ("status", status),
+        ("bytes", number_of_bytes),
+        ("latency_sec", round(latency, 3)),
+        ("attempt", attempt),
+        ("sleep_sec", round(slept, 3)),
+        ("error", error),
+    ])))
+
+
+#every request to the server goes through here: wait for the rate limiter, fetch with the shared session, adapt the rate.
+#The request is logged as a JSON line and counted in the metrics of its step - attempt and backoff_sec are given by
+#the retry engine (the time slept is the backoff before this attempt plus the wait for the rate limiter)
+def rate_limited_get(url_to_get, step = "study_harvest", attempt = 1, backoff_sec = 0.0, **kwargs):
+    slept = backoff_sec + wait_for_rate_limit()
+    request_start = time.monotonic()
+    status, number_of_bytes, error = None, None, None
+    try:
+        page = get_http_session().get(url_to_get, **kwargs)
+        status = page.status_code
+        if kwargs.get("stream"):
+            number_of_bytes = int(page.headers.get("Content-Length", 0))
+        else:
+            number_of_bytes = len(page.content)
+        update_rate_limit(page.status_code, page.headers)
+        return page
+    except Exception as exception:
+        error = str(exception)
+        raise
+    finally:
+        log_request(step, url_to_get, status, number_of_bytes, time.monotonic() - request_start, attempt, slept, error)
 
 
 # just get the content of a page
 def get_page(url_to_get, sec):
-    page = requests.get(url = url_to_get, timeout = sec)
+    page = rate_limited_get(url_to_get, timeout = sec)
     return page
 
 # read a json file
@@ -52,138 +334,1097 @@ def load_json_file(file):
           
         
         
-#ccmri - method to get json from url and return json content to a variable
-def get_json_url_with_exception_handling(url_that_contains_json, timeout_in_sec, sleep_min, sleep_max, limiter):
-    if DEEP_LOG:
-        print("check: get_json_url_with_exception_handling: ", "url: ", url_that_contains_json, "limiter: ", limiter)
+#the retry engine: every error is classified and its class decides whether a new attempt is worth it and how long to back off.
+#The backoff of attempt N is a random value in [sleep_min, sleep_max] * backoff_factor * 2^(N-1), capped to MAX_BACKOFF_SEC.
+RETRY_POLICIES = {
+    "timeout":          {"retry": True,  "backoff_factor": 1},
+    "connection_error": {"retry": True,  "backoff_factor": 2},
+    "throttled":        {"retry": True,  "backoff_factor": 2},    # 429/503 - the rate limiter also slows everybody down
+    "server_error":     {"retry": True,  "backoff_factor": 1},    # any other 5xx
+    "client_error":     {"retry": False, "backoff_factor": 0},    # 4xx (i.e. 404) - asking again will not help
+    "invalid_json":     {"retry": True,  "backoff_factor": 1},
+    "bad_url":          {"retry": False, "backoff_factor": 0},    # too many redirects
+    "incomplete_file":  {"retry": True,  "backoff_factor": 1},    # a download ended before its expected size
+    "offline_miss":     {"retry": False, "backoff_factor": 0},    # offline mode and the url is not in the response cache
+    "other":            {"retry": True,  "backoff_factor": 1},
+}
+MAX_BACKOFF_SEC = 120
+
+#the urls that permanently failed are kept in a tab separated ledger on disk (key, url, error class, error, attempts, time),
+#so that a later run can re-drive only those. The key tells what the url was needed for (a study ID or "study_list").
+FAILURE_LEDGER_PATH = None
+failure_ledger_lock = threading.Lock()
 
-    if limiter==0:
-        print("Permanently failed to get json from url: ", url_that_contains_json, "\n")
+
+#starts a new (empty) failure ledger for the given path. The failures are written to a temporary file, the ledger at the path
+#(the previous run's failures) is only replaced by finalize_failure_ledger() when the run finishes, so a crashed run keeps it
+def configure_failure_ledger(ledger_path):
+    global FAILURE_LEDGER_PATH
+    with failure_ledger_lock:
+        FAILURE_LEDGER_PATH = ledger_path + ".tmp"
+        open(FAILURE_LEDGER_PATH, "w", encoding='utf-8').close()
+
+
+#replaces the ledger of the previous run with the failures of this run
+def finalize_failure_ledger(ledger_path):
+    with failure_ledger_lock:
+        os.replace(FAILURE_LEDGER_PATH, ledger_path)
+
+
+#appends a permanently failed url to the ledger
+def record_failure(url, error_class, error, attempts, ledger_key):
+    print("Permanently failed to get url: ", url, " after ", attempts, " attempt(s) - ", error_class, ": ", error, "\n")
+    if FAILURE_LEDGER_PATH is None:
         return
+    error = re.sub(r'[\t\n\r]', ' ', str(error))
+    with failure_ledger_lock:
+        with open(FAILURE_LEDGER_PATH, "a", encoding='utf-8') as ledger:
+            ledger.write("\t".join([str(ledger_key), url, error_class, error, str(attempts), str(datetime.datetime.now())]) + "\n")
+
+
+#reads a failure ledger and returns its entries as a list of dictionaries (an empty list if there is no ledger)
+def load_failure_ledger(ledger_path):
+    failures = []
+    if not os.path.exists(ledger_path):
+        return failures
+    with open(ledger_path, "r", encoding='utf-8') as ledger:
+        for line in ledger:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) >= 5:
+                failures.append({"key": columns[0], "url": columns[1], "error_class": columns[2], "error": columns[3], "attempts": int(columns[4])})
+    return failures
+
+
+#enables the response cache in cache_dir (None disables it), bounded to max_bytes, optionally serving only from the cache
+def configure_response_cache(cache_dir, max_bytes, offline):
+    global RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_OFFLINE, response_cache_size
+    with response_cache_lock:
+        RESPONSE_CACHE_DIR = cache_dir
+        RESPONSE_CACHE_MAX_BYTES = int(max_bytes)
+        RESPONSE_CACHE_OFFLINE = offline
+        response_cache_size = 0
+        if RESPONSE_CACHE_DIR is not None:
+            check_create_dir(RESPONSE_CACHE_DIR)
+            response_cache_size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(RESPONSE_CACHE_DIR, "*", "*")))
+
+
+def get_response_cache_paths(url):
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    cache_subdir = os.path.join(RESPONSE_CACHE_DIR, key[:2])
+    return cache_subdir, os.path.join(cache_subdir, key + ".body"), os.path.join(cache_subdir, key + ".meta")
+
+
+#returns (metadata, body) of a cached url or None. A hit marks the entry as recently used (for the LRU eviction)
+def read_cached_response(url):
+    if RESPONSE_CACHE_DIR is None:
+        return None
+    cache_subdir, body_path, meta_path = get_response_cache_paths(url)
     try:
-        variable_to_load_json=""
-        sleepy = random.uniform(sleep_min, sleep_max)
-        time.sleep(sleepy)
-        #print ("Slept for: ", sleepy, " seconds")
-        url_page = get_page(url_that_contains_json, timeout_in_sec)
-        if url_page.status_code == 200:
-            variable_to_load_json = load_json_file(url_page)
-            return variable_to_load_json
-        else:
-            print("An HTTP error occured : ", url_page.status_code, " - while downloading URL: ",url_that_contains_json, "\n")
-            get_json_url_with_exception_handling(url_that_contains_json, timeout_in_sec, sleep_min, sleep_max, limiter-1)
-    except Exception as error:
-            print("An exception error occured : ", error, " - while downloading URL: ",url_that_contains_json, "\n")
-            get_json_url_with_exception_handling(url_that_contains_json, timeout_in_sec, sleep_min, sleep_max, limiter-1)
+        with open(meta_path, "r", encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        with open(body_path, "rb") as body_file:
+            body = body_file.read()
+        os.utime(body_path, None)
+        return meta, body
+    except (IOError, ValueError):
+        return None
 
 
+#stores the answer of a url (its headers and content) in the cache (atomically: temporary files first, then renamed)
+#and evicts if needed
+def write_cached_response(url, headers, content):
+    global response_cache_size
+    if RESPONSE_CACHE_DIR is None:
+        return
+    cache_subdir, body_path, meta_path = get_response_cache_paths(url)
+    check_create_dir(cache_subdir)
+    meta = {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+            "content_type": headers.get("Content-Type"), "stored": str(datetime.datetime.now())}
+    old_size = sum(os.path.getsize(path) for path in (body_path, meta_path) if os.path.exists(path))
+    temp_suffix = ".tmp" + str(threading.get_ident())
+    with open(body_path + temp_suffix, "wb") as body_file:
+        body_file.write(content)
+    with open(meta_path + temp_suffix, "w", encoding='utf-8') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(body_path + temp_suffix, body_path)
+    os.replace(meta_path + temp_suffix, meta_path)
+    new_size = os.path.getsize(body_path) + os.path.getsize(meta_path)
+    with response_cache_lock:
+        response_cache_size += new_size - old_size
+        if response_cache_size > RESPONSE_CACHE_MAX_BYTES:
+            evict_response_cache()
 
-# get urls from failed_urls list
-def retry(failed_urls, directory_to_save, suffix, sleep_min, sleep_max):
-    print("i am inside the retry function!")
-    sec = random.uniform(sleep_min,sleep_max)
-    if len(failed_urls) == 0:
-        print("All urls are downloaded properly!")
-        pass
-    else:
-        url = failed_urls[0]
-        print("url under process: " + url)
-        page = requests.get(url, allow_redirects = True, timeout = 130)
-        time.sleep(sec)
+
+#removes the least recently used entries until the cache is down to 90% of its limit (called with the lock held)
+def evict_response_cache():
+    global response_cache_size
+    entries = []
+    for body_path in glob.glob(os.path.join(RESPONSE_CACHE_DIR, "*", "*.body")):
+        meta_path = body_path[:-len(".body")] + ".meta"
+        try:
+            size = os.path.getsize(body_path) + (os.path.getsize(meta_path) if os.path.exists(meta_path) else 0)
+            entries.append((os.path.getmtime(body_path), size, body_path, meta_path))
+        except OSError:
+            continue
+    entries.sort()
+    response_cache_size = sum(entry[1] for entry in entries)
+    for last_used, size, body_path, meta_path in entries:
+        if response_cache_size <= RESPONSE_CACHE_MAX_BYTES * 0.9:
+            break
+        for path in (body_path, meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        response_cache_size -= size
+
+
+#builds a response object (as if it came from the server) out of a cached entry
+def build_cached_response(url, meta, body):
+    page = requests.Response()
+    page.status_code = 200
+    page.url = url
+    page._content = body
+    page.encoding = "utf-8"
+    page.headers = CaseInsensitiveDict({"Content-Type": meta.get("content_type") or "application/json", "X-From-Cache": "1"})
+    if meta.get("etag"):
+        page.headers["ETag"] = meta["etag"]
+    if meta.get("last_modified"):
+        page.headers["Last-Modified"] = meta["last_modified"]
+    return page
+
+
+#returns the seconds to wait before the next attempt (exponential backoff with jitter)
+def get_backoff_seconds(error_class, attempt, sleep_min, sleep_max):
+    backoff = random.uniform(sleep_min, sleep_max) * RETRY_POLICIES[error_class]["backoff_factor"] * (2 ** (attempt - 1))
+    return min(MAX_BACKOFF_SEC, backoff)
+
+
+#classifies the answer (or the exception) of a request, returns None when the page is fine
+def classify_page_error(page, want_json):
+    status_error = classify_status_code(page.status_code)
+    if status_error is not None:
+        return status_error
+    if want_json:
+        try:
+            page.json()
+        except ValueError as error:
+            return "invalid_json", error
+    return None
+
+
+def classify_status_code(status_code):
+    if status_code in (429, 503):
+        return "throttled", "HTTP " + str(status_code)
+    if status_code >= 500:
+        return "server_error", "HTTP " + str(status_code)
+    if status_code >= 400:
+        return "client_error", "HTTP " + str(status_code)
+    if status_code != 200:
+        return "other", "HTTP " + str(status_code)
+    return None
+
+
+def classify_exception(error):
+    if isinstance(error, Timeout):
+        return "timeout"
+    if isinstance(error, requests.exceptions.TooManyRedirects):
+        return "bad_url"
+    if isinstance(error, (requests.exceptions.ConnectionError, http.client.HTTPException)):
+        return "connection_error"
+    return "other"
+
+
+#the single retry engine used by all the fetch helpers: tries up to max_attempts times, backing off between the attempts
+#according to RETRY_POLICIES, and returns the page (None if every attempt failed - the url is then kept in the ledger).
+#When the response cache is enabled, a cached url is revalidated and a 304 is answered from the cache
+def fetch_with_retry(url, timeout_in_sec, sleep_min, sleep_max, max_attempts, ledger_key = None, want_json = True):
+    cached = read_cached_response(url)
+    if RESPONSE_CACHE_OFFLINE:
+        if cached is not None:
+            return build_cached_response(url, cached[0], cached[1])
+        record_failure(url, "offline_miss", "not in the response cache", 0, ledger_key)
+        return None
+    conditional_headers = {}
+    if cached is not None:
+        if cached[0].get("etag"):
+            conditional_headers["If-None-Match"] = cached[0]["etag"]
+        if cached[0].get("last_modified"):
+            conditional_headers["If-Modified-Since"] = cached[0]["last_modified"]
+
+    error_class, error = "other", "no attempt was made"
+    step = "study_list" if ledger_key == "study_list" else "study_harvest"
+    backoff = 0.0
+    attempt = 0
+    while attempt < max_attempts:
+        attempt += 1
         try:
-            try_page = page.json()
-        except:
-            print("i had an exception...")
-            pass
-        if str(page.status_code) == '200':
-            print("i have a new file downloaded!")
-            number_of_page = url.split("=")[1]
-            filename = directory_to_save + str(number_of_page) + suffix
-            open(filename, 'wb').write(page.content)
-            failed_urls.remove(url)
+            page = rate_limited_get(url, step, attempt, backoff, headers = conditional_headers, allow_redirects = True, timeout = timeout_in_sec)
+            if page.status_code == 304 and cached is not None:
+                return build_cached_response(url, cached[0], cached[1])
+            page_error = classify_page_error(page, want_json)
+            if page_error is None:
+                write_cached_response(url, page.headers, page.content)
+                return page
+            error_class, error = page_error
+        except Exception as exception:
+            error_class, error = classify_exception(exception), exception
+        print("Attempt ", attempt, " of ", max_attempts, " failed - ", error_class, ": ", error, " - while downloading URL: ", url, "\n")
+        if not RETRY_POLICIES[error_class]["retry"] or attempt == max_attempts:
+            break
+        backoff = get_backoff_seconds(error_class, attempt, sleep_min, sleep_max)
+        time.sleep(backoff)
+    record_failure(url, error_class, error, attempt, ledger_key)
+    return None
 
 
 
-def download_pages(url, path_to_save, prefix, timeout_time, sleep_min, sleep_max):
+#ccmri - method to get json from url and return json content to a variable (None if it permanently failed)
+def get_json_url_with_exception_handling(url_that_contains_json, timeout_in_sec, sleep_min, sleep_max, limiter, ledger_key = None):
     if DEEP_LOG:
-        print("check: download_pages: ", "url: ", url, " path_to_save: ", path_to_save, " prefix:", prefix)
+        url_calls_logger.debug(json.dumps({"check": "get_json_url_with_exception_handling", "url": url_that_contains_json, "limiter": limiter}))
+
+    url_page = fetch_with_retry(url_that_contains_json, timeout_in_sec, sleep_min, sleep_max, limiter, ledger_key)
+    if url_page is None:
+        return None
+    return load_json_file(url_page)
+
+
+
+#an insertion ordered registry of the study IDs met so far, along with their MGnify last-update. Looking up or adding an ID
+#is O(1) (a dictionary instead of a list), and a folder named with the study ID is created only the first time it is added.
+#The registry is what decides which study is new, it gives the last-updates to the incremental manifest check and its
+#add() result tells the caller whether the study should go to the STEP 3 work queue
+class StudyRegistry:
+
+    def __init__(self, harvested_studies_dir):
+        self.harvested_studies_dir = harvested_studies_dir
+        self.studies = OrderedDict()
+        self.lock = threading.Lock()
+
+    #returns True if the study ID is new (and creates its folder), False if it is a duplicate
+    def add(self, study_id, last_update = None):
+        with self.lock:
+            if study_id in self.studies:
+                return False
+            self.studies[study_id] = last_update
+        check_create_dir(self.harvested_studies_dir + study_id)
+        return True
+
+    def get_last_update(self, study_id):
+        return self.studies.get(study_id)
+
+    def study_ids(self):
+        return list(self.studies)
+
+    def __contains__(self, study_id):
+        return study_id in self.studies
+
+    def __len__(self):
+        return len(self.studies)
+
+
+
+#The PMID frequencies: for every PMID, the number of distinct studies that have it as a publication (what
+#edit_studyids_pmids.csh counts with sort | uniq | cut -f2 | uniq -c over studyid_pmid.tsv). The harvest keeps them up to
+#date study by study in a SQLite file that is kept between the runs, so that the blocklist of the formulation is derived
+#from it without a sort of the whole pair file. The (study, PMID) pairs are kept as well, so a pair is only counted once
+class PmidStudyCounter:
+
+    def __init__(self, counter_path):
+        self.counter_path = counter_path
+        self.connection = sqlite3.connect(counter_path, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS study_pmid (study TEXT, pmid TEXT, PRIMARY KEY (study, pmid))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pmid_study_count (pmid TEXT PRIMARY KEY, studies INTEGER)")
+
+    def _add_pair(self, study_id, pmid):
+        if self.connection.execute("INSERT OR IGNORE INTO study_pmid VALUES (?, ?)", (study_id, pmid)).rowcount == 1:
+            self.connection.execute("INSERT OR IGNORE INTO pmid_study_count VALUES (?, 0)", (pmid,))
+            self.connection.execute("UPDATE pmid_study_count SET studies = studies + 1 WHERE pmid = ?", (pmid,))
+
+    #counts the PMIDs of a study (the ones already counted for this study are not counted again), in one transaction
+    def add_study_pmids(self, study_id, pmids):
+        with self.lock:
+            with self.connection:
+                for pmid in pmids:
+                    self._add_pair(study_id, pmid)
+
+    #counts all the pairs of a studyid_pmid.tsv file (study ID - PMID) in one streaming pass
+    def add_pairs_file(self, pairs_path):
+        with self.lock:
+            with self.connection:
+                with open(pairs_path, "r", encoding='utf-8') as pairs_file:
+                    for line in pairs_file:
+                        line = line.rstrip("\n")
+                        if line:
+                            columns = line.split("\t")
+                            if len(columns) == 1:
+                                # like cut -f2, a line without a tab is taken as a whole
+                                self._add_pair(line, line)
+                            else:
+                                self._add_pair(columns[0], columns[1])
+
+    #returns the (PMID, number of studies) pairs of the PMIDs that more than threshold studies have, most frequent first
+    def get_pmids_above(self, threshold):
+        with self.lock:
+            return self.connection.execute("SELECT pmid, studies FROM pmid_study_count WHERE studies > ? ORDER BY studies DESC, pmid", (threshold,)).fetchall()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM study_pmid").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+#opens the PMID frequencies of a working directory: an empty counter is filled once with the pairs that are already in
+#the studyid_pmid.tsv file (if any), so that it also counts the studies harvested before the counter existed
+def open_pmid_study_counter(counter_path, pairs_path):
+    counter = PmidStudyCounter(counter_path)
+    if len(counter) == 0 and os.path.exists(pairs_path):
+        print("Counting the PMIDs of the existing study - PMID pairs: ", pairs_path, "\n")
+        counter.add_pairs_file(pairs_path)
+    return counter
+
+
+
+#the study manifest is a tab separated file (study ID - MGnify last-update) that is kept between the runs, so that an
+#incremental run only harvests the studies that are new or have changed upstream
+def load_study_manifest(manifest_path):
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path, "r", encoding='utf-8') as manifest_file:
+        for line in manifest_file:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) == 2:
+                manifest[columns[0]] = columns[1]
+    return manifest
+
+
+#writes the manifest to a temporary file first and then renames it, so that a crash never leaves a half written manifest
+def save_study_manifest(manifest_path, manifest):
+    temp_manifest_path = manifest_path + ".tmp"
+    with open(temp_manifest_path, "w", encoding='utf-8') as manifest_file:
+        for study_id in sorted(manifest):
+            manifest_file.write(study_id + "\t" + manifest[study_id] + "\n")
+    os.replace(temp_manifest_path, manifest_path)
 
-    # try to get a response for your url
+
+#returns the study_last_update value of an already harvested mined_info file (None if the file or the line is missing)
+def read_last_update_from_mined_info(mined_info_path):
     try:
-        sleepy = random.uniform(sleep_min, sleep_max)
-        time.sleep(sleepy)
-        #print("A new url is about to start downloading: " + str(datetime.datetime.now()))
-        samples_page = requests.get(url, allow_redirects = True, timeout = timeout_time)
-        print(url + "\t" + "status: " + str(samples_page.status_code))
-        # if everything is fine, then save the page.
-        if str(samples_page.status_code) == '200':
-            try_page = samples_page.json()
-            suffix = url.split("=")[1]
-            filename = path_to_save + suffix + prefix
-            open(filename, 'wb').write(samples_page.content)
-            print("the corresponding page was saved! \n")
-            message = "ok"
-            return message
-        # if an error was returned then keep the url for the retry step.
+        with open(mined_info_path, "r", encoding='utf-8') as mined_info:
+            for line in mined_info:
+                if line.startswith("study_last_update\t"):
+                    return line.rstrip("\n").split("\t")[1]
+    except IOError:
+        pass
+    return None
+
+
+
+#the study records: one typed record per study (study, associated studies, biomes, publications, samples), kept for all
+#the studies in one JSON-lines dataset. The texts are already cleaned, a missing bioproject/sample description is None,
+#publications is None when the server gave no publications and samples is None when the samples were not harvested
+study_records_lock = threading.Lock()
+
+
+def build_study_record(study_json, pub_json, sample_pages):
+    attributes = study_json['data']['attributes']
+    relationships = study_json['data']['relationships']
+    record = OrderedDict([
+        ("study_id", study_json['data']['id']),
+        ("study_name", clean_text(attributes['study-name'])),
+        ("study_abstract", clean_text(attributes['study-abstract'])),
+        ("study_origination", attributes['data-origination']),
+        ("study_bioproject_id", attributes['bioproject'] or None),
+        ("study_secondary_accession", attributes['secondary-accession']),
+        ("study_last_update", attributes['last-update']),
+        ("associated_studies", [asc_study['id'] for asc_study in relationships['studies']['data']]),
+        ("biomes", [biome['id'] for biome in relationships['biomes']['data']]),
+        ("publications", None),
+        ("samples", None),
+    ])
+    if pub_json is not None:
+        record["publications"] = [OrderedDict([
+            ("pubmed_id", publication['attributes']['pubmed-id']),
+            ("title", publication['attributes']['pub-title']),
+            ("publication_year", publication['attributes']['published-year']),
+        ]) for publication in pub_json['data']]
+    if sample_pages is not None:
+        record["samples"] = [OrderedDict([
+            ("sample_id", sample['attributes']['accession']),
+            ("sample_description", clean_text(sample['attributes']['sample-desc']) if sample['attributes']['sample-desc'] else None),
+        ]) for sam_json in sample_pages for sample in sam_json['data']]
+    return record
+
+
+#appends a study record to the dataset, a study that is harvested again is appended again (the last record wins)
+def append_study_record(dataset_path, record):
+    record_line = json.dumps(record, ensure_ascii=False) + "\n"
+    with study_records_lock:
+        with open(dataset_path, "a", encoding='utf-8') as dataset:
+            dataset.write(record_line)
+
+
+#reads the whole dataset in one pass and returns the latest record of every study, by study ID in order of appearance
+def load_study_records(dataset_path):
+    records = OrderedDict()
+    if not os.path.exists(dataset_path):
+        return records
+    with open(dataset_path, "r", encoding='utf-8') as dataset:
+        for line in dataset:
+            if line.strip():
+                record = json.loads(line, object_pairs_hook=OrderedDict)
+                records[record["study_id"]] = record
+    return records
+
+
+#the compatibility exporter: writes a study record in the layout of the mined_info_<study ID>.txt files
+def export_study_record_to_mined_info(record, mined_info_path):
+    with open(mined_info_path, "w", encoding='utf-8') as f:
+        f.write("study_id\t"+record["study_id"]+"\n")
+        f.write("study_name\t"+record["study_name"]+"\n")
+        f.write("study_abstract\t"+record["study_abstract"]+"\n")
+        f.write("study_origination\t"+record["study_origination"]+"\n")
+        f.write("study_bioproject_id\t"+(record["study_bioproject_id"] or "unavailable")+"\n")
+        f.write("study_secondary_acession\t"+record["study_secondary_accession"]+"\n")
+        f.write("study_last_update\t"+record["study_last_update"]+"\n")
+        for asc_study, asc_study_id in enumerate(record["associated_studies"]):
+            f.write("associated_study_"+str(asc_study)+"\t"+asc_study_id+"\n")
+        for biome, biome_id in enumerate(record["biomes"]):
+            f.write("biome_info_"+str(biome)+"\t"+biome_id+"\n")
+        f.write("=========================================================================================\n")
+
+        if record["publications"] is not None:
+            for publication, pub_record in enumerate(record["publications"]):
+                f.write("publication_nr_"+str(publication)+"_pubmed_id\t"+str(pub_record["pubmed_id"])+"\n")
+                f.write("publication_nr_"+str(publication)+"_title\t"+str(pub_record["title"])+"\n")
+                f.write("publication_nr_"+str(publication)+"_publication_year\t"+str(pub_record["publication_year"])+"\n")
         else:
-            print("this url: " + url + "returned an error:" + str(samples_page.status_code) + " and has been kept in a temp file.")
-    # if timeout is over, then also keep the url for the retry step.
-    except Timeout:
-        print(url + " got a TIMEOUT! \n")
-    # in case that a request exceeds the configured number of maximum redirections
-    except requests.exceptions.TooManyRedirects:
-        print("url: " + url + " ..this is a bad url! no clue how this may have happened.. that is a crucial error for this script. ")
-    # check for a HTTP client disconnection
-    except http.client.HTTPException:
-        print("a Connection Error occured while trying to get the " + url + " it was the http.client excpetion that was hit!")
-    # if a connection error occurs
-    except requests.exceptions.ConnectionError:
-        print("a Connection Error occured while trying to get the " + url)
-    # in case that any other exception takes place
-    except requests.exceptions.RequestException:
-        print("a kind of error that i do not understand took place.. please try again later with this url: " + url)
-
-
-
-#created for ccmri - downloading available file downloads from mgnify
-def download_file_via_wget_url(url, path_to_save, sleep_min, sleep_max, limiter):
+            f.write("Publications unavailable from the server\n")
+        f.write("=========================================================================================\n")
+
+        if record["samples"] is not None:
+            for sample_nr, sample in enumerate(record["samples"]):
+                f.write("sample_nr_"+str(sample_nr)+"_sample_id\t"+str(sample["sample_id"])+"\n")
+                if sample["sample_description"] is not None:
+                    f.write("sample_nr_"+str(sample_nr)+"_sample_description\t"+str(sample["sample_description"])+"\n")
+                else:
+                    f.write("sample_nr_"+str(sample_nr)+"_sample_description\tunavailable\n")
+            f.write("\n")
+
+
+#downloads a study file (i.e. a taxonomic analysis .tsv) in a resumable way: the data go to <filename>.part and, if a
+#.part file is already there from a previous attempt or run, only the missing bytes are asked with an HTTP Range request
+#(If-Range with the ETag kept next to it, so that a file that changed on the server is downloaded from the start).
+#The size is verified against Content-Length/Content-Range and the file is atomically renamed to its final name.
+#Returns the path of the downloaded file (None if every attempt failed - the url is then kept in the failure ledger)
+def download_file_with_resume(url, path_to_save, timeout_in_sec, sleep_min, sleep_max, max_attempts, ledger_key = None):
     if DEEP_LOG:
-        print("check: download_file_via_wget_url: ", "url: ", url, "limiter: ", limiter)
+        url_calls_logger.debug(json.dumps({"check": "download_file_with_resume", "url": url, "path_to_save": path_to_save}))
+
+    filename = url.split("?")[0].rstrip("/").split("/")[-1]
+    final_path = os.path.join(path_to_save, filename)
+    if os.path.exists(final_path):
+        print("The file is already downloaded:", filename, "\n")
+        return final_path
+    part_path = final_path + ".part"
+    etag_path = part_path + ".etag"
+
+    error_class, error = "other", "no attempt was made"
+    backoff = 0.0
+    attempt = 0
+    while attempt < max_attempts:
+        attempt += 1
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            etag = None
+            if os.path.exists(etag_path):
+                with open(etag_path, "r", encoding='utf-8') as etag_file:
+                    etag = etag_file.read().strip() or None
+            # no gzip for the files, so that Content-Length and Range are counted in bytes of the file itself
+            headers = {"Accept-Encoding": "identity"}
+            if offset > 0:
+                headers["Range"] = "bytes={}-".format(offset)
+                if etag:
+                    headers["If-Range"] = etag
+            page = rate_limited_get(url, "downloads", attempt, backoff, headers = headers, stream = True, allow_redirects = True, timeout = timeout_in_sec)
+            try:
+                if page.status_code == 416:
+                    # the range asked is not there - the .part file does not match the file on the server anymore
+                    os.remove(part_path)
+                    error_class, error = "incomplete_file", "HTTP 416 - the partial file was discarded"
+                elif page.status_code in (200, 206):
+                    expected_size = None
+                    if page.status_code == 206:
+                        mode = "ab"
+                        content_range = page.headers.get("Content-Range", "")
+                        if "/" in content_range and content_range.split("/")[-1] != "*":
+                            expected_size = int(content_range.split("/")[-1])
+                    else:
+                        # a full answer (no partial file, or the file changed since the partial download)
+                        mode = "wb"
+                        if page.headers.get("Content-Length"):
+                            expected_size = int(page.headers["Content-Length"])
+                    new_etag = page.headers.get("ETag")
+                    if new_etag:
+                        with open(etag_path, "w", encoding='utf-8') as etag_file:
+                            etag_file.write(new_etag)
+                    with open(part_path, mode) as part_file:
+                        for chunk in page.iter_content(chunk_size = 1024 * 1024):
+                            if chunk:
+                                part_file.write(chunk)
+                    downloaded_size = os.path.getsize(part_path)
+                    if expected_size is None or downloaded_size == expected_size:
+                        os.replace(part_path, final_path)
+                        if os.path.exists(etag_path):
+                            os.remove(etag_path)
+                        print("The file was downloaded:", filename, "(", downloaded_size, "bytes )\n")
+                        return final_path
+                    error_class, error = "incomplete_file", "got {} of {} bytes".format(downloaded_size, expected_size)
+                    if downloaded_size > expected_size:
+                        os.remove(part_path)
+                else:
+                    error_class, error = classify_page_error(page, False)
+            finally:
+                page.close()
+        except Exception as exception:
+            error_class, error = classify_exception(exception), exception
+        print("Attempt ", attempt, " of ", max_attempts, " failed - ", error_class, ": ", error, " - while downloading file: ", url, "\n")
+        if not RETRY_POLICIES[error_class]["retry"] or attempt == max_attempts:
+            break
+        backoff = get_backoff_seconds(error_class, attempt, sleep_min, sleep_max)
+        time.sleep(backoff)
+    record_failure(url, error_class, error, attempt, ledger_key)
+    return None
+
+
+
+#the tags that clean_text strips itself: plain formatting tags, whose content is text for BeautifulSoup as well.
+#Anything else (script/style and the other raw-text elements, comments, declarations, quoted attributes, entities, a
+#stray '<') is left to BeautifulSoup, so that the output is always the one of BeautifulSoup(...).get_text()
+SIMPLE_HTML_TAG_NAMES = {"a", "abbr", "b", "bdi", "bdo", "big", "blockquote", "br", "caption", "center", "cite", "code",
+                         "dd", "del", "dfn", "div", "dl", "dt", "em", "font", "h1", "h2", "h3", "h4", "h5", "h6", "hr",
+                         "i", "ins", "kbd", "li", "mark", "ol", "p", "pre", "q", "s", "samp", "small", "span", "strike",
+                         "strong", "sub", "sup", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "tt", "u", "ul", "var"}
+SIMPLE_HTML_TAG_PATTERN = re.compile(r'<(/?)([A-Za-z][A-Za-z0-9]*)(?:\s[^<>"\'&]*)?/?>')
+WHITESPACE_RUN_PATTERN = re.compile(r'[\t\n\r ]+')
+
+
+#removes the simple formatting tags of a text in one pass, returns None if the text has any other kind of markup
+def strip_simple_html_tags(input_text):
+    text_parts = []
+    position = 0
+    for tag in SIMPLE_HTML_TAG_PATTERN.finditer(input_text):
+        if tag.group(2).lower() not in SIMPLE_HTML_TAG_NAMES:
+            return None
+        text_parts.append(input_text[position:tag.start()])
+        position = tag.end()
+    text_parts.append(input_text[position:])
+    stripped_text = "".join(text_parts)
+    # BeautifulSoup turns a text between two tags made only of whitespace that includes a form feed into a single space
+    if "<" in stripped_text or "\x0c" in stripped_text:
+        return None
+    return stripped_text
+
 
-    if limiter==0:
-        print("Permanently failed to download from URL: ", url, "\n")
-        return
-    try:
-        sleepy = random.uniform(sleep_min, sleep_max)
-        time.sleep(sleepy)
-        filename = wget.detect_filename(url)
-        print("The filename is : ", filename, "\n")
-        wget.download(url, out=path_to_save)
-        isExist = os.path.exists(path_to_save+"/"+filename)
-        if isExist:
-            print("The file was downloaded:", filename, "\n")
-        else:
-            print("The file was NOT downloaded:", filename, "and the function will return(which is wrong)" "\n")
-        return 
-    except Exception as error:
-        print("An error occured : ", error, " - while downloading URL: ",url, "\n")
-        print("The file was NOT downloaded:", filename, "\n")
-        download_file_via_wget_url(url, path_to_save, sleep_min, sleep_max, limiter-1)
-        
-        
-        
 #cleans text from newlines,spaces and HTML code
 def clean_text(input_text):
-    # Remove HTML code
-    cleaned_text = BeautifulSoup(input_text, "html.parser").get_text()
-
-    # Replace tabs, newlines, and carriage returns with spaces
-    cleaned_text = re.sub(r'[\t\n\r]', ' ', cleaned_text)
+    # Remove HTML code: most texts have no markup at all and the rest mostly have simple formatting tags, which are
+    # stripped without building a parse tree. Only entities and messy HTML are parsed by BeautifulSoup
+    cleaned_text = None
+    if isinstance(input_text, str) and "&" not in input_text:
+        if "<" not in input_text:
+            cleaned_text = input_text
+        else:
+            cleaned_text = strip_simple_html_tags(input_text)
+    if cleaned_text is None:
+        cleaned_text = BeautifulSoup(input_text, "html.parser").get_text()
 
-    # Replace consecutive spaces with a single space
-    cleaned_text = re.sub(r' +', ' ', cleaned_text)
+    # Replace tabs, newlines, carriage returns and the consecutive spaces with a single space
+    cleaned_text = WHITESPACE_RUN_PATTERN.sub(' ', cleaned_text)
 
     # Remove trailing whitespaces
     cleaned_text = cleaned_text.rstrip()
 
-    return cleaned_text
\ No newline at end of file
+    return cleaned_text
+
+
+#the PubMed abstract index: a SQLite table (PMID -> byte offset and length of its line in the PubMed TSV) that is built
+#once, so that the abstracts of the studies are read with random access instead of a scan of the whole PubMed TSV.
+#The lines are split like the text mode reading of the TSV does (\n, \r\n and \r all end a line) and only the lines
+#with an abstract (6 or more columns) are indexed. The size and mtime of the TSV are kept to detect a stale index
+PUBMED_INDEX_BATCH_SIZE = 100000
+PUBMED_TSV_LINE_PATTERN = re.compile(rb'[^\r\n]*(?:\r\n|\r|\n)?')
+
+
+def build_pubmed_index(pubmed_tsv_file_path, index_path):
+    temp_index_path = index_path + ".tmp"
+    if os.path.exists(temp_index_path):
+        os.remove(temp_index_path)
+    connection = sqlite3.connect(temp_index_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("CREATE TABLE pubmed_index (pmid TEXT, offset INTEGER, length INTEGER)")
+    connection.execute("CREATE TABLE pubmed_index_meta (key TEXT PRIMARY KEY, value TEXT)")
+    batch = []
+    counter = 0
+    offset = 0
+    with open(pubmed_tsv_file_path, "rb") as pubmed_tsv:
+        for binary_line in pubmed_tsv:
+            # a line of the binary file is one line of the text mode file, unless it has a lone \r
+            pieces = [binary_line] if b"\r" not in binary_line[:-2] else [piece for piece in PUBMED_TSV_LINE_PATTERN.findall(binary_line) if piece]
+            for piece in pieces:
+                if piece.count(b"\t") >= 5:
+                    batch.append((piece[:piece.index(b"\t")].split(b"|")[0].decode("utf-8"), offset, len(piece)))
+                offset += len(piece)
+                counter += 1
+            if len(batch) >= PUBMED_INDEX_BATCH_SIZE:
+                connection.executemany("INSERT INTO pubmed_index VALUES (?, ?, ?)", batch)
+                batch = []
+                print("Indexed: " + str(counter) + " PubMed lines")
+    connection.executemany("INSERT INTO pubmed_index VALUES (?, ?, ?)", batch)
+    print("Indexed: " + str(counter) + " PubMed lines, now creating the PMID index")
+    connection.execute("CREATE INDEX pubmed_index_pmid ON pubmed_index (pmid)")
+    tsv_stat = os.stat(pubmed_tsv_file_path)
+    connection.executemany("INSERT INTO pubmed_index_meta VALUES (?, ?)", [("tsv_size", str(tsv_stat.st_size)), ("tsv_mtime", str(tsv_stat.st_mtime))])
+    connection.commit()
+    connection.close()
+    os.replace(temp_index_path, index_path)
+
+
+#True if the index exists and was built from the current version of the PubMed TSV
+def is_pubmed_index_current(pubmed_tsv_file_path, index_path):
+    if not os.path.exists(index_path) or not os.path.exists(pubmed_tsv_file_path):
+        return False
+    connection = sqlite3.connect(index_path)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM pubmed_index_meta").fetchall())
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+    tsv_stat = os.stat(pubmed_tsv_file_path)
+    return meta.get("tsv_size") == str(tsv_stat.st_size) and meta.get("tsv_mtime") == str(tsv_stat.st_mtime)
+
+
+#returns the abstract column of a PubMed TSV line (as it was read in text mode) encoded in utf-8
+def get_abstract_of_pubmed_line(binary_line):
+    line = binary_line.decode("utf-8")
+    if line.endswith("\r\n"):
+        line = line[:-2] + "\n"
+    elif line.endswith("\r"):
+        line = line[:-1] + "\n"
+    return line.split("\t")[5].encode('utf-8')
+
+
+#the index lookup: the same dictionary (PMID:<id> -> abstract text in utf-8) as a scan of the PubMed TSV, read with one
+#seek per selected PMID in file order. When a PMID has more than one line, the last one is kept like the scan does
+def get_pubmed_abstracts_from_index(selected_pubmedid_dictionary, pubmed_tsv_file_path, index_path):
+    selected_pmids = list(selected_pubmedid_dictionary)
+    pmid_locations = {}
+    connection = sqlite3.connect(index_path)
+    for start in range(0, len(selected_pmids), 500):
+        pmid_chunk = selected_pmids[start:start + 500]
+        query = "SELECT pmid, offset, length FROM pubmed_index WHERE pmid IN (" + ",".join("?" * len(pmid_chunk)) + ") ORDER BY rowid"
+        for pmid, offset, length in connection.execute(query, pmid_chunk):
+            pmid_locations[pmid] = (offset, length)
+    connection.close()
+
+    pubmed_dict = {}
+    with open(pubmed_tsv_file_path, "rb") as pubmed_tsv:
+        for pmid, (offset, length) in sorted(pmid_locations.items(), key=lambda location: location[1][0]):
+            pubmed_tsv.seek(offset)
+            pubmed_dict[pmid] = get_abstract_of_pubmed_line(pubmed_tsv.read(length))
+    return pubmed_dict
+
+
+#the cold path of the PubMed abstracts, when there is no index: the PubMed TSV is split in newline aligned byte ranges
+#that are scanned by a pool of processes. Every process compares the PMID column (the bytes up to the first '|') with
+#the selected PMIDs before decoding anything and returns its matches in file order; the partial results are merged in
+#the order of the ranges, so that (like the single thread scan) the last line of a PMID wins
+PUBMED_SCAN_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+#returns the newline aligned (start, end) byte ranges of a file, at least number_of_chunks of them
+def get_newline_aligned_chunks(file_path, number_of_chunks):
+    file_size = os.path.getsize(file_path)
+    chunk_size = max(1, min(PUBMED_SCAN_CHUNK_BYTES, file_size // max(1, number_of_chunks)))
+    chunks = []
+    start = 0
+    with open(file_path, "rb") as input_file:
+        while start < file_size:
+            input_file.seek(min(start + chunk_size, file_size))
+            input_file.readline()
+            end = min(input_file.tell(), file_size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+#the work of one process: the (PMID:<id>, abstract text in utf-8) pairs of the selected PMIDs in a byte range of the
+#PubMed TSV. The lines are split like the text mode reading of the TSV does (\n, \r\n and \r all end a line)
+def scan_pubmed_chunk(pubmed_tsv_file_path, start, end, selected_pmids):
+    with open(pubmed_tsv_file_path, "rb") as pubmed_tsv:
+        pubmed_tsv.seek(start)
+        data = pubmed_tsv.read(end - start)
+    matches = []
+    binary_lines = data.split(b"\n")
+    last_line_nr = len(binary_lines) - 1
+    for line_nr, binary_line in enumerate(binary_lines):
+        pieces = binary_line.split(b"\r") if b"\r" in binary_line else [binary_line]
+        for piece_nr, piece in enumerate(pieces):
+            tab = piece.find(b"\t")
+            if tab == -1 or piece[:tab].split(b"|")[0] not in selected_pmids:
+                continue
+            columns = piece.split(b"\t")
+            if len(columns) < 6:
+                continue
+            abstract = columns[5]
+            # the text mode line ends with "\n" (unless it is the unterminated last line of the file)
+            if len(columns) == 6 and (line_nr < last_line_nr or piece_nr < len(pieces) - 1):
+                abstract += b"\n"
+            matches.append((piece[:tab].split(b"|")[0].decode("utf-8"), abstract.decode("utf-8").encode('utf-8')))
+    return matches
+
+
+#the same dictionary (PMID:<id> -> abstract text in utf-8) as the single thread scan of the PubMed TSV
+def get_pubmed_abstracts_with_parallel_scan(selected_pubmedid_dictionary, pubmed_tsv_file_path, number_of_processes):
+    selected_pmids = frozenset(pmid.encode("utf-8") for pmid in selected_pubmedid_dictionary)
+    chunks = get_newline_aligned_chunks(pubmed_tsv_file_path, 4 * number_of_processes)
+    print("Scanning the PubMed file in ", len(chunks), " byte ranges with ", number_of_processes, " processes\n")
+    pubmed_dict = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers = number_of_processes) as scan_executor:
+        chunk_futures = [scan_executor.submit(scan_pubmed_chunk, pubmed_tsv_file_path, start, end, selected_pmids) for start, end in chunks]
+        for chunk_nr, chunk_future in enumerate(chunk_futures):
+            pubmed_dict.update(chunk_future.result())
+            if DEEP_LOG:
+                print("Scanned: " + str(chunk_nr + 1) + " of " + str(len(chunks)) + " byte ranges, " + str(len(pubmed_dict)) + " abstracts found so far")
+    return pubmed_dict
+
+
+
+#the formulation of the mined_info files (formulate_studies_for_classifier.py): every mined_info file is read once into
+#memory, then the abstracts of its publications are attached and its blocked publications are removed. The functions
+#are here so that they can run in the processes of a process pool
+
+PUBLICATION_LINE_PATTERN = re.compile(r"publication_nr_(\d+)_")
+PUBLICATION_START_PATTERN = re.compile(r"publication_nr_\d+_pubmed_id")
+SEPARATOR_LINE = "========================================================================================="
+
+
+def contains_blocked_pubmed_id(line, blocked_ids, blocked_id_lengths):
+    """
+    Checks if a line contains "_pubmed_id\t<blocked ID>" for any of the blocked IDs, with set lookups of the text that
+    follows every "_pubmed_id\t" (one lookup per distinct length of the blocked IDs) instead of a scan of the blocklist.
+
+    Args:
+        line (str): The line to check.
+        blocked_ids (set): Set of blocked IDs.
+        blocked_id_lengths (set): The lengths of the blocked IDs.
+
+    Returns:
+        bool: True if the line contains a blocked ID.
+    """
+    marker = "_pubmed_id\t"
+    position = line.find(marker)
+    while position != -1:
+        id_start = position + len(marker)
+        for length in blocked_id_lengths:
+            if line[id_start:id_start + length] in blocked_ids:
+                return True
+        position = line.find(marker, position + 1)
+    return False
+
+
+def sort_lines_by_publication_order(new_lines, blocked_ids):
+    """
+    Sorts the lines for the same publication_nr in the desired order:
+    _pubmed_id, _pubmed_title, _pubmed_abstract, _pubmed_ebi_link, _publication_year.
+    Removes all lines for any publication containing a blocked ID.
+    Keeps the existing separator lines in their original positions and
+    sorts publication numbers in ascending order.
+
+    The lines are parsed once into a publication model (the lines of every publication_nr and, for every line, whether
+    it keeps its position), then the sorted publications are emitted and renumbered in a single pass.
+
+    Args:
+        new_lines (list): List of lines to process.
+        blocked_ids (set): Set (or list) of blocked IDs to filter out.
+
+    Returns:
+        list: Sorted list of lines with publication_nr fields in the correct order,
+              while keeping the separator lines in their original positions and
+              excluding publications with blocked IDs.
+    """
+    # Define the desired order of keys
+    order = ["_pubmed_id", "_title", "_pubmed_abstract", "_EBI_link", "_publication_year"]
+    blocked_ids = set(blocked_ids)
+    blocked_id_lengths = set(len(blocked_id) for blocked_id in blocked_ids)
+
+    # Step 1: Parse the lines once: the publication lines are grouped by their publication_nr, the separators and the
+    # rest of the (non-empty) lines keep their position. The publication lines and the empty lines are the slots that
+    # the sorted publication lines are written to
+    grouped_lines = {}
+    keeps_position = []
+    for line in new_lines:
+        if SEPARATOR_LINE in line:
+            keeps_position.append(True)
+        elif not line.strip():
+            keeps_position.append(False)
+        else:
+            prefix_match = PUBLICATION_LINE_PATTERN.match(line)
+            if prefix_match:
+                grouped_lines.setdefault(int(prefix_match.group(1)), []).append(line)
+                keeps_position.append(False)
+            else:
+                keeps_position.append(True)
+
+    # Step 2: Sort the publications that have no blocked ID in ascending publication_nr, every publication by the
+    # desired field order followed by any unmatched lines
+    sorted_publications = []
+    for pub_nr in sorted(grouped_lines):
+        lines = grouped_lines[pub_nr]
+        if blocked_ids and any(contains_blocked_pubmed_id(line, blocked_ids, blocked_id_lengths) for line in lines):
+            continue
+        for key in order:
+            sorted_publications.extend([line for line in lines if key in line])
+        sorted_publications.extend([line for line in lines if not any(key in line for key in order)])
+
+    # Step 3: Emit the lines and renumber the publications (id, title, abstract, etc.) starting from 0 in the same pass:
+    # a publication starts with its "publication_nr_X_pubmed_id" line and ends with its "_publication_year" line
+    final_lines = []
+    publication_index = 0
+    publication_count = 0
+    publication_start = None   # index in final_lines of the pubmed_id line of the current publication
+    for line, keeps in zip(new_lines, keeps_position):
+        if not keeps:
+            if publication_index >= len(sorted_publications):
+                continue
+            line = sorted_publications[publication_index]
+            publication_index += 1
+        final_lines.append(line)
+        if PUBLICATION_START_PATTERN.match(line):
+            if publication_start is not None:
+                # the previous publication has no _publication_year line, it ends here
+                publication_count = renumber_publication(final_lines, publication_start, len(final_lines) - 1, publication_count)
+            publication_start = len(final_lines) - 1
+        elif publication_start is not None and "_publication_year" in line:
+            publication_count = renumber_publication(final_lines, publication_start, len(final_lines), publication_count)
+            publication_start = None
+
+    return final_lines
+
+
+def renumber_publication(final_lines, start, end, publication_count):
+    """
+    Renumbers the lines final_lines[start:end] of a publication as publication_count.
+
+    Returns:
+        int: The next publication number.
+    """
+    for i in range(start, end):
+        final_lines[i] = PUBLICATION_LINE_PATTERN.sub("publication_nr_{}_".format(publication_count), final_lines[i])
+    return publication_count + 1
+
+
+def read_mined_info_file(mined_info_path):
+    """
+    Reads a mined_info file once.
+
+    Args:
+        mined_info_path (str): Path to the mined_info file.
+
+    Returns:
+        tuple: The lines of the file and the pubmed IDs of its publications (in file order).
+    """
+    with open(mined_info_path, 'r', encoding='utf-8') as mined_info:
+        lines = mined_info.readlines()
+    pubmed_ids = [line.strip().split('\t')[1] for line in lines if "_pubmed_id" in line]
+    return lines, pubmed_ids
+
+
+def read_mined_info_pubmed_ids(mined_info_path):
+    """
+    Returns:
+        list: The pubmed IDs of the publications of a mined_info file (in file order).
+    """
+    return read_mined_info_file(mined_info_path)[1]
+
+
+#the blocklist of the processes of the formulation pool, given once to every process by init_formulation_worker()
+FORMULATION_BLOCKLIST = set()
+
+
+def init_formulation_worker(blocklist):
+    global FORMULATION_BLOCKLIST
+    FORMULATION_BLOCKLIST = blocklist
+
+
+def formulate_mined_info_file_in_worker(mined_info_path, pubmed_id_to_text_dictionary):
+    """
+    formulate_mined_info_file() for the processes of the formulation pool: the mined_info file is read by the process
+    itself and formulated with the blocklist of the pool.
+    """
+    lines, pubmed_ids = read_mined_info_file(mined_info_path)
+    return formulate_mined_info_file(mined_info_path, lines, pubmed_id_to_text_dictionary, FORMULATION_BLOCKLIST)
+
+
+def formulate_mined_info_file(mined_info_path, lines, pubmed_id_to_text_dictionary, blocklist):
+    """
+    Formulates a mined_info file out of its lines: the abstract and the EBI link of every publication with a known
+    abstract are attached and the sorted lines are written to mined_info_<study ID>_abstracted.txt. If the file has
+    blocked publications, they are also removed from the mined_info file itself (unless it already has abstracts).
+
+    Args:
+        mined_info_path (str): Path to the mined_info file.
+        lines (list): The lines of the mined_info file.
+        pubmed_id_to_text_dictionary (dict): The abstracts (PMID:<id> -> abstract text in utf-8) of the publications.
+        blocklist (set): Set of blocked PubMed IDs.
+
+    Returns:
+        tuple: The log messages of the file, whether an _abstracted file was written, whether it has blocked IDs and
+        its entry in the formulation manifest: the signature of the mined_info file after the formulation (mtime, size
+        and sha1), the formulation status ("abstracted", "partial" when some of the abstracts are missing,
+        "missing_abstracts" or "no_abstracts"), the number of missing abstracts and the mtime and size of the
+        _abstracted file ("" if there is none).
+    """
+    messages = []
+    new_lines = []
+    file_abstracted = 0
+    pubmed_id_blocked = 0
+    missing_abstracts = 0
+    nr_of_papers_found = 0
+    for line in lines:
+        new_lines.append(line)
+        if "_pubmed_id" in line:
+            nr_of_papers_found += 1
+            #extract the pubmed id to check the blocklist
+            pubmed_id = line.strip().split('\t')[1]
+            #will check the blocklist
+            if pubmed_id not in blocklist:
+                pubmed_id_for_dict = "PMID:"+pubmed_id
+                if pubmed_id_for_dict in pubmed_id_to_text_dictionary:
+                    messages.append("Key found in dict! : " + pubmed_id_for_dict + " for file: " + mined_info_path)
+                    file_abstracted = 1
+                    extra_cleaned_abstract = clean_text(pubmed_id_to_text_dictionary[pubmed_id_for_dict].decode('utf-8'))
+                    # Prepare the new lines for abstract and link
+                    new_lines.append("publication_nr_" + str(nr_of_papers_found - 1) + "_pubmed_abstract\t" + extra_cleaned_abstract + "\n")
+                    new_lines.append("publication_nr_" + str(nr_of_papers_found - 1) + "_EBI_link\thttps://www.ebi.ac.uk/metagenomics/publications/" + pubmed_id + "\n")
+                else:
+                    missing_abstracts += 1
+                    messages.append("Key NOT found in dict! : " + pubmed_id_for_dict + " for file: " + mined_info_path)
+            else:
+                pubmed_id_blocked = 1
+                messages.append("This pubmed id is blocked: " + pubmed_id + " (from: " + mined_info_path + ")")
+
+    abstracted_file_path = mined_info_path.replace(".txt", "")+"_abstracted.txt"
+    if file_abstracted:
+        #sort the lines properly
+        with open(abstracted_file_path, 'w', encoding='utf-8') as abstracted_file:
+            abstracted_file.writelines(sort_lines_by_publication_order(new_lines, blocklist))
+    elif os.path.exists(abstracted_file_path):
+        # the mined_info file changed since it was abstracted and none of its publications has an abstract any more
+        os.remove(abstracted_file_path)
+        messages.append("The outdated abstracted file was removed: " + abstracted_file_path)
+
+    #now dealing with blocked publication info in the mined_info file itself (just containing pubmed id, title and year)
+    if pubmed_id_blocked:
+        if any("_pubmed_abstract\t" in line for line in lines):
+            messages.append("Abstracted file: " + mined_info_path + " - no changes made")
+        else:
+            try:
+                filtered_lines = sort_lines_by_publication_order(lines, blocklist)
+                with open(mined_info_path, 'w', encoding='utf-8') as mined_info:
+                    mined_info.writelines(filtered_lines)
+                lines = filtered_lines
+                messages.append("File '{}' has been successfully overwritten.".format(mined_info_path))
+            except IOError:
+                messages.append("Error: Unable to open or write to the file '{}'.".format(mined_info_path))
+
+    if file_abstracted:
+        status = "partial" if missing_abstracts else "abstracted"
+    elif missing_abstracts:
+        status = "missing_abstracts"
+    else:
+        status = "no_abstracts"
+    manifest_entry = get_mined_info_signature(mined_info_path, lines)
+    manifest_entry["status"] = status
+    manifest_entry["missing_abstracts"] = str(missing_abstracts)
+    manifest_entry.update(get_abstracted_file_signature(abstracted_file_path))
+    return messages, file_abstracted, pubmed_id_blocked, manifest_entry
+
+
+#the formulation manifest is a tab separated file (study ID, mtime, size and sha1 of its mined_info file after the
+#formulation, formulation status and number of missing abstracts, mtime and size of its _abstracted file, version of the
+#PubMed file and hash of the blocklist it was formulated with) that is kept between the runs, so that a rerun only
+#formulates the studies whose mined_info or _abstracted file changed, whose missing abstracts may be in a new PubMed file
+#or that were formulated with another blocklist
+FORMULATION_MANIFEST_COLUMNS = ["study_id", "mtime", "size", "sha1", "status", "missing_abstracts", "abstracted_mtime",
+                                "abstracted_size", "pubmed_version", "blocklist_hash"]
+
+
+def get_mined_info_signature(mined_info_path, lines):
+    """
+    Returns:
+        OrderedDict: The mtime and the size of a mined_info file and the sha1 of its lines.
+    """
+    file_stat = os.stat(mined_info_path)
+    return OrderedDict([
+        ("mtime", str(file_stat.st_mtime)),
+        ("size", str(file_stat.st_size)),
+        ("sha1", hashlib.sha1("".join(lines).encode('utf-8')).hexdigest()),
+    ])
+
+
+def get_abstracted_file_signature(abstracted_file_path):
+    """
+    Returns:
+        OrderedDict: The mtime and the size of an _abstracted file ("" if it does not exist).
+    """
+    if not os.path.exists(abstracted_file_path):
+        return OrderedDict([("abstracted_mtime", ""), ("abstracted_size", "")])
+    file_stat = os.stat(abstracted_file_path)
+    return OrderedDict([("abstracted_mtime", str(file_stat.st_mtime)), ("abstracted_size", str(file_stat.st_size))])
+
+
+def get_blocklist_hash(blocklist, threshold):
+    """
+    Returns:
+        str: The sha1 of the threshold and the sorted PubMed IDs of the blocklist.
+    """
+    return hashlib.sha1("\n".join([str(threshold)] + sorted(blocklist)).encode('utf-8')).hexdigest()
+
+
+def get_pubmed_version(pubmed_tsv_file_path):
+    """
+    Returns:
+        str: The size and the mtime of the PubMed file, that change with every new PubMed file ("" if it is missing).
+    """
+    if not os.path.exists(pubmed_tsv_file_path):
+        return ""
+    tsv_stat = os.stat(pubmed_tsv_file_path)
+    return str(tsv_stat.st_size) + ":" + str(tsv_stat.st_mtime)
+
+
+def load_formulation_manifest(manifest_path):
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path, "r", encoding='utf-8') as manifest_file:
+        for line in manifest_file:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) == len(FORMULATION_MANIFEST_COLUMNS):
+                manifest[columns[0]] = OrderedDict(zip(FORMULATION_MANIFEST_COLUMNS[1:], columns[1:]))
+    return manifest
+
+
+#writes the manifest to a temporary file first and then renames it, so that a crash never leaves a half written manifest
+def save_formulation_manifest(manifest_path, manifest):
+    temp_manifest_path = manifest_path + ".tmp"
+    with open(temp_manifest_path, "w", encoding='utf-8') as manifest_file:
+        for study_id in sorted(manifest):
+            manifest_file.write("\t".join([study_id] + [manifest[study_id][column] for column in FORMULATION_MANIFEST_COLUMNS[1:]]) + "\n")
+    os.replace(temp_manifest_path, manifest_path)